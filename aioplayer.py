@@ -0,0 +1,278 @@
+import math
+import queue
+import asyncio
+import threading
+from mpd import MPDError, CommandError
+from mpd.asyncio import MPDClient
+from player import Player, PlayerStatus, PlayerCommand, StatusSnapshot
+from connection import MPDConnection
+
+
+# ------------------------------------------------------------------------------
+class AsyncPlayer:
+    # asyncio 版の Player
+    #   コマンドは await できるコルーチン、状態の変化は status_changes() の非同期イテレータで受け取る
+    #   mpd.asyncio の MPDClient は1本の接続で idle とコマンドを切り替えるので、接続は1つだけ使う
+    #   同じループの周回で呼ばれたコマンドは、Player と同じく PlayerCommand.coalesce でまとめて送る
+    def __init__(self, host=None, port=None):
+        self.__host = host or Player.HOST
+        self.__port = port or Player.PORT
+        self.__client = MPDClient()
+        self.__status = PlayerStatus()
+        self.__snapshot = StatusSnapshot()
+        self.__connection = 0       # 接続し直すたびに増やす (status_changes が idle をやり直すため)
+        self.__connect_lock = None
+        self.__pending = []         # まだ送っていないコマンド
+        self.__flushing = None      # コマンドを送っているタスク
+        self.__queue_version = None
+        self.__queue_files = []
+
+    @property
+    def status(self):
+        return self.__snapshot
+
+    @property
+    def sequence(self):
+        return self.__snapshot.sequence
+
+    @property
+    def connected(self):
+        return self.__client.connected
+
+    async def connect(self):
+        # 接続していなければ接続する。コマンドと status_changes のどちらからも呼ばれる
+        # (Lock はイベントループの中で作る)
+        if self.__connect_lock is None:
+            self.__connect_lock = asyncio.Lock()
+        async with self.__connect_lock:
+            if self.__client.connected:
+                return
+            self.__client = MPDClient()
+            await self.__client.connect(self.__host, self.__port)
+            self.__connection += 1
+
+    def disconnect(self):
+        if self.__client.connected:
+            self.__client.disconnect()
+
+    async def status_changes(self):
+        # PlayerStatus.copy と同じ形式の変化を返し続ける
+        # 経過時間は Player と同じく、前回の status からの経過時間で求める
+        # 接続が切れた場合は MPDConnection と同じ間隔で接続し直す
+        loop = asyncio.get_running_loop()
+        s = PlayerStatus()
+        status = {}
+        received = 0
+        failures = 0
+        reported = None
+        connection = None
+        changed = None
+        while True:
+            if not self.__client.connected or connection != self.__connection:
+                try:
+                    await self.connect()
+                    connection = self.__connection
+                    changes = self.__client.idle(Player.IDLE_SUBSYSTEMS)
+                    changed = None
+                    status, received = await self.__client.status(), loop.time()
+                    failures = 0
+                except (MPDError, OSError) as e:
+                    self.disconnect()
+                    failures += 1
+                    backoff = min(MPDConnection.MAX_BACKOFF, MPDConnection.MIN_BACKOFF * 2 ** (failures - 1))
+                    print('AsyncPlayer: {} (retry in {:.1f}s)'.format(e, backoff))
+                    if reported is not False:
+                        reported = False
+                        self.__snapshot = StatusSnapshot(self.__status, reported, self.__snapshot.sequence + 1)
+                        yield {'connected': False}
+                    await asyncio.sleep(backoff)
+                    continue
+
+            if status.get('state') == 'play' and 'elapsed' in status:
+                s.update(dict(status, elapsed=float(status['elapsed']) + loop.time() - received))
+            else:
+                s.update(status)
+            modified = self.__status.copy(s)
+            if reported is not True:
+                reported = True
+                modified['connected'] = True
+            if modified:
+                self.__snapshot = StatusSnapshot(self.__status, reported, self.__snapshot.sequence + 1)
+                yield modified
+
+            # 演奏中は経過時間の秒が次に変わるまで、それ以外は変化があるまで待つ
+            timeout = None
+            if status.get('state') == 'play' and 'elapsed' in status:
+                elapsed = float(status['elapsed']) + loop.time() - received
+                timeout = math.floor(elapsed) + 1 - elapsed
+            if changed is None:
+                changed = asyncio.ensure_future(changes.__anext__())
+                # 接続し直して使われなくなった場合の例外は無視する
+                changed.add_done_callback(lambda f: f.cancelled() or f.exception())
+            done, _ = await asyncio.wait([changed], timeout=timeout)
+            if not done:
+                continue
+            try:
+                changed.result()
+                changed = None
+                status, received = await self.__client.status(), loop.time()
+            except (MPDError, OSError, StopAsyncIteration) as e:
+                # 接続が切れた場合や応答が不正な場合は、接続し直して status から取得し直す
+                print('AsyncPlayer: {} {}'.format(type(e).__name__, e))
+                self.disconnect()
+
+    # --------------------------------------------------------------------------
+    async def post(self, name, *args):
+        command = PlayerCommand(name, *args)
+        self.__pending.append(command)
+        if self.__flushing is None:
+            self.__flushing = asyncio.ensure_future(self.flush())
+        return await asyncio.wrap_future(command.future)
+
+    async def flush(self):
+        # 同じ周回で呼ばれたコマンドが揃うのを待ってから、まとめて送る
+        await asyncio.sleep(0)
+        while self.__pending:
+            commands, self.__pending = self.__pending, []
+            await self.send_commands(commands)
+        self.__flushing = None
+
+    async def send_commands(self, commands):
+        try:
+            await self.connect()
+            client = self.__client
+            status = None
+            files = None
+            if PlayerCommand.needs_status(commands):
+                status = await client.status()
+                if any(c.name == 'set_album' for c in commands):
+                    files = await self.get_queue(status)
+            requests = PlayerCommand.coalesce(commands, status, files)
+            # command_list の代わりに、応答を待たずに続けて送る (mpd.asyncio は送った順に応答を処理する)
+            await asyncio.gather(*[getattr(client, name)(*args) for name, args in requests])
+        except (MPDError, OSError) as e:
+            print('AsyncPlayer: {}'.format(e))
+            if not isinstance(e, CommandError):
+                self.disconnect()
+            for command in commands:
+                command.future.set_exception(e)
+            return
+        for command in commands:
+            command.future.set_result(None)
+
+    async def get_queue(self, status):
+        # Player.get_queue と同じく、変わった部分だけを plchanges で取得する
+        version = int(status.get('playlist') or 0)
+        length = int(status.get('playlistlength') or 0)
+        if self.__queue_version is None:
+            files = [song['file'] for song in await self.__client.playlistinfo()]
+        elif self.__queue_version != version:
+            files = self.__queue_files[:length]
+            files += [None] * (length - len(files))
+            for song in await self.__client.plchanges(self.__queue_version):
+                files[int(song['pos'])] = song['file']
+        else:
+            files = self.__queue_files
+        self.__queue_version = version
+        self.__queue_files = files
+        return files
+
+    async def set_album(self, album):
+        return await self.post('set_album', album.get_playlist())
+
+    async def play(self, song):   # song はゼロが１曲目
+        return await self.post('play', song)
+
+    async def toggle_pause(self):
+        return await self.post('toggle_pause')
+
+    async def next(self):
+        return await self.post('next')
+
+    async def previous(self):
+        return await self.post('previous')
+
+    async def stop(self):
+        return await self.post('stop')
+
+# ------------------------------------------------------------------------------
+class AsyncPlayerAdapter:
+    # AsyncPlayer を専用のスレッドのイベントループで動かし、Player と同じ同期のインターフェースを提供する
+    # (Application.run などのスレッド版を前提とした呼び出し側をそのまま使える)
+    def __init__(self, host=None, port=None):
+        self.__loop = asyncio.new_event_loop()
+        self.__player = AsyncPlayer(host, port)
+        self.__queue = queue.Queue()
+        self.__notify = None
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+        self.__task = self.call(self.receive())
+
+    @property
+    def status(self):
+        # スナップショットは変更されないので、別のスレッドからそのまま読んでよい
+        return self.__player.status
+
+    @property
+    def sequence(self):
+        return self.__player.sequence
+
+    @property
+    def connected(self):
+        return self.__player.connected
+
+    def call(self, coroutine):
+        # イベントループのスレッドでコルーチンを実行し、concurrent.futures.Future を返す
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop)
+
+    async def receive(self):
+        async for modified in self.__player.status_changes():
+            self.__queue.put(modified)
+            if self.__notify:
+                self.__notify()
+
+    def get_modified(self):
+        return self.__queue.get() if not self.__queue.empty() else None
+
+    def set_notify(self, callback):
+        self.__notify = callback
+
+    def quit(self):
+        try:
+            self.stop().result(timeout=5)
+        except Exception as e:
+            print('Player: {}'.format(e))
+        self.call(self.close()).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+        print('Player: terminated')
+
+    async def close(self):
+        self.__task.cancel()
+        await asyncio.gather(asyncio.wrap_future(self.__task), return_exceptions=True)
+        self.__player.disconnect()
+        # mpd.asyncio の MPDClient が内部で動かしているタスク (disconnect で取り消されただけで、まだ終わっていない) や
+        # 送信中のコマンドも、ループを止める前に終わらせておく
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def set_album(self, album):
+        return self.call(self.__player.set_album(album))
+
+    def play(self, song):   # song はゼロが１曲目
+        return self.call(self.__player.play(song))
+
+    def toggle_pause(self):
+        return self.call(self.__player.toggle_pause())
+
+    def next(self):
+        return self.call(self.__player.next())
+
+    def previous(self):
+        return self.call(self.__player.previous())
+
+    def stop(self):
+        return self.call(self.__player.stop())
@@ -1,28 +1,51 @@
 import pygame
 import os
 import sys
-import time
 import json
 import shutil
 import subprocess
 import RPi.GPIO as GPIO
 
-from player import ArtistList, Player
+from player import ArtistList, Artist, Player
+from aioplayer import AsyncPlayerAdapter
+from catalog  import Catalog
+from snapshot import Snapshot
+from watcher  import LibraryWatcher
 from ui     import UIWidget, Desktop, TouchManager
+from reactor import Reactor
 from view   import NavigationView, ArtistListView, AlbumListView, PlaybackView
 
 class Application:
     CONFIG_PATH = '/home/pi/player/config.json'
+    DATABASE_PATHS = ['/media/usb/database.bin', '/media/usb/database.json']
+    LOADING_INTERVAL = 0.1
 
     def __init__(self):
         self.__terminated = False
 
+        self.__config = self.read_config()
+
         self.__artist_list = ArtistList()
-        self.__artist_list.load('/media/usb/database.json')
+        self.__database_path = [path for path in self.DATABASE_PATHS if os.path.isfile(path)][0]
+        # 前回終了時のスナップショットが有効であれば、データベースの解析・画像のデコードを省略する
+        self.__snapshot = Snapshot()
+        catalog = self.__snapshot.restore(self.__database_path, Artist.image_cache)
+        if catalog is None:
+            catalog = Catalog.load(self.__database_path)
+            self.__snapshot.set_catalog(self.__database_path, catalog)
+        # 前回演奏していたアーティストだけを先に読み込み、残りはバックグラウンドで読み込む
+        self.__artist_list.load_catalog(catalog, self.__config.get('artist'))
+        # USB メモリへのアルバムの追加・削除を監視する
+        self.__watcher = LibraryWatcher(Artist.ROOT_PATH, self.__artist_list)
         
-        self.__player = Player()
+        # config.json に "player": "asyncio" があれば asyncio 版の Player を使う
+        if self.__config.get('player') == 'asyncio':
+            self.__player = AsyncPlayerAdapter()
+        else:
+            self.__player = Player()
         
         self.__touch = TouchManager()
+        self.__reactor = Reactor()
 
         self.__desktop = Desktop()
         
@@ -43,12 +66,16 @@ class Application:
         self.__playback_view.attach_event('album', self.show_album_list)
         self.__playback_view.attach_event('artist', self.show_artist_list)
 
-    def load_config(self):
+    def read_config(self):
         if os.path.isfile(self.CONFIG_PATH):
             with open(self.CONFIG_PATH, mode='r', encoding='utf-8') as fp:
-                config = json.load(fp)
-            artist = self.__artist_list.get_artist_by_id(config['artist'])
-            album  = artist.get_album_by_id(config['album'])
+                return json.load(fp)
+        return {}
+
+    def load_config(self):
+        config = self.__config
+        if 'artist' in config and 'album' in config:
+            album = self.__artist_list.find_saved_album(config['artist'], config['album'])
         else:
             artist = self.__artist_list.artists[0]
             album = artist.albums[0]
@@ -56,36 +83,77 @@ class Application:
 
     def save_config(self):
         with open(self.CONFIG_PATH, mode='w', encoding='utf-8') as fp:
-            config = {
-                'artist': self.__playback_view.album.artist.artist_id,
-                'album': self.__playback_view.album.album_id
-            }
+            config = dict(self.__config,
+                artist=self.__playback_view.album.artist.artist_id,
+                album=self.__playback_view.album.album_id
+            )
             json.dump(config, fp, ensure_ascii=False, indent=4)
 
+    def save_snapshot(self):
+        try:
+            self.__snapshot.save(self.__database_path, Artist.image_cache)
+        except OSError as e:
+            print('failed to save snapshot ({})'.format(e))
+
+    def apply_library_changes(self):
+        delta = self.__watcher.get_delta()
+        while delta:
+            artist = self.__artist_list.apply_delta(delta)
+            if artist:
+                self.__album_listview.update_list(artist)
+            delta = self.__watcher.get_delta()
+
     def run(self):
         self.load_config()
 
         self.__desktop.show()
         self.__touch.add_event_listener(self.__desktop)
-        
+
+        # タッチパネルの入力・Player の状態の変化・ライブラリの変更・タイマーの期限のいずれかまで眠る
+        self.__reactor.add_reader(self.__touch.fileno(), self.__touch.read_device)
+        self.__player.set_notify(self.__reactor.wakeup)
+        self.__watcher.set_notify(self.__reactor.wakeup)
+
         while not self.__terminated:
-            modified_states = self.__player.get_modified() or {}
-            if self.__touch.dispatch_event():
+            while self.__touch.dispatch_event():
                 UIWidget.timer.reset()
             widget = UIWidget.timer.get_expired()
-            if widget:
+            while widget:
                 widget.on_timeout()
-            self.__navigation_view.update(modified_states)
-            self.__playback_view.update(modified_states)
-            time.sleep(0.1)
-
+                widget = UIWidget.timer.get_expired()
+            modified_states = self.__player.get_modified()
+            while modified_states:
+                self.__navigation_view.update(modified_states)
+                self.__playback_view.update(modified_states)
+                modified_states = self.__player.get_modified()
+            self.apply_library_changes()
+            self.__artist_listview.update_list()
+            UIWidget.frames.flush()
+            if self.__terminated:
+                break
+            self.__reactor.wait(self.next_timeout())
+
+        # Player・LibraryWatcher のスレッドは終了するまで wakeup を呼ぶので、先に止めてから Reactor を閉じる
+        self.__player.set_notify(None)
+        self.__watcher.set_notify(None)
+        self.__player.quit()
+        self.__watcher.quit()
+        self.__reactor.close()
         self.__touch.quit()
         self.__touch = None
         self.__desktop = None
         UIWidget.timer.quit()
         pygame.quit()
-        self.__player.quit()
         self.save_config()
+        self.save_snapshot()
+
+    def next_timeout(self):
+        timeouts = [t for t in [UIWidget.timer.next_timeout(), UIWidget.frames.next_timeout()] if t is not None]
+        timeout = min(timeouts) if timeouts else None
+        if not self.__artist_list.loaded:
+            # バックグラウンドでの読み込み中は、アーティストの一覧を更新するために定期的に起きる
+            timeout = min(timeout, self.LOADING_INTERVAL) if timeout is not None else self.LOADING_INTERVAL
+        return timeout
 
     def shutdown(self, params):
         self.__terminated = True
@@ -0,0 +1,152 @@
+import os
+import glob
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+# ------------------------------------------------------------------------------
+class ImageCache:
+    DEFAULT_BUDGET = 16 * 1024 * 1024   # 16MB (240x240 の RGB 画像でおよそ 90 枚分)
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.__budget = budget
+        self.__images = OrderedDict()   # path -> (image, 使用バイト数)。末尾ほど最近使われたもの
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def budget(self):
+        return self.__budget
+    @budget.setter
+    def budget(self, v):
+        self.__lock.acquire()
+        try:
+            self.__budget = v
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def count(self):
+        return len(self.__images)
+
+    @staticmethod
+    def image_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key, loader=None):
+        # key は通常は画像ファイルのパス。loader を指定した場合は loader(key) で画像を得る
+        self.__lock.acquire()
+        try:
+            entry = self.__images.get(key)
+            if entry:
+                self.__images.move_to_end(key)
+                return entry[0]
+        finally:
+            self.__lock.release()
+
+        # デコードには時間がかかるので、ロックの外で行う
+        try:
+            image = loader(key) if loader else Image.open(key).convert('RGB')
+        except OSError as e:
+            print('[ImageCache] failed to load {} ({})'.format(key, e))
+            return None
+        if image is None:
+            return None
+        self.put(key, image)
+        return image
+
+    def put(self, key, image):
+        nbytes = ImageCache.image_bytes(image)
+        self.__lock.acquire()
+        try:
+            old = self.__images.pop(key, None)
+            if old:
+                self.__size -= old[1]
+            self.__images[key] = (image, nbytes)
+            self.__size += nbytes
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def items(self):
+        # (key, image) の一覧を、最も長く使われていないものから順に返す
+        self.__lock.acquire()
+        try:
+            return [(key, entry[0]) for key, entry in self.__images.items()]
+        finally:
+            self.__lock.release()
+
+    def discard(self, key):
+        self.__lock.acquire()
+        try:
+            old = self.__images.pop(key, None)
+            if old:
+                self.__size -= old[1]
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__images.clear()
+            self.__size = 0
+        finally:
+            self.__lock.release()
+
+    def __evict(self):
+        # 予算を超えている間、最も長く使われていないものから捨てる
+        # (直前に追加した1枚は予算を超えていても残す)
+        while self.__size > self.__budget and len(self.__images) > 1:
+            key, (image, nbytes) = self.__images.popitem(last=False)
+            self.__size -= nbytes
+
+# ------------------------------------------------------------------------------
+class Thumbnail:
+    SIZES = [(146, 146), (240, 240)]
+    DIRECTORY = '.thumbnails'
+
+    # サムネイルは <root>/.thumbnails/<元画像の相対パス>.<幅>x<高さ>.<元画像の mtime>.png に置く
+    # 元画像が更新されると mtime が変わるので、古いサムネイルは自動的に使われなくなる
+    def __init__(self, root):
+        self.__root = root
+
+    def path(self, source, size):
+        try:
+            mtime = os.stat(source).st_mtime_ns
+        except OSError:
+            return None
+        return '{}.{}x{}.{}.png'.format(self.__base(source), size[0], size[1], mtime)
+
+    def __base(self, source):
+        rel = os.path.splitext(os.path.relpath(source, self.__root))[0]
+        return os.path.join(self.__root, Thumbnail.DIRECTORY, rel)
+
+    def generate(self, source):
+        # 全てのサイズのサムネイルを作成する。既に最新のものがあれば何もしない
+        image = None
+        for size in Thumbnail.SIZES:
+            path = self.path(source, size)
+            if path is None or os.path.isfile(path):
+                continue
+            if image is None:
+                image = Image.open(source).convert('RGB')
+            # 同じ元画像・同じサイズの古いサムネイルを削除する
+            for old in glob.glob(glob.escape('{}.{}x{}.'.format(self.__base(source), size[0], size[1])) + '*.png'):
+                os.remove(old)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.resize(size, resample=Image.BICUBIC).save(path)
+
+    def load(self, source, size):
+        path = self.path(source, size)
+        if path is None:
+            return None
+        if os.path.isfile(path):
+            return Image.open(path).convert('RGB')
+        # サムネイルが未作成(updator を実行していない)の場合は元画像から縮小する
+        return Image.open(source).convert('RGB').resize(size, resample=Image.BICUBIC)
@@ -0,0 +1,95 @@
+import os
+import sys
+import gc
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import updator
+from player import ArtistList
+from synthlib import make_library, FORMATS
+from benchutil import write_results
+
+
+# ------------------------------------------------------------------------------
+def run_update(root, **kwargs):
+    # updator の出力(アルバムごとの表示など)は計測の邪魔なので捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        updator.update(root, **kwargs)
+        return time.perf_counter() - t
+
+def run_load(path):
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        artist_list = ArtistList()
+        artist_list.load(path)
+    elapsed = time.perf_counter() - t
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, peak
+
+def best_of(repeat, proc):
+    return min(proc() for i in range(repeat))
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='updator / catalog loading benchmark on a synthetic library')
+    parser.add_argument('--artists', type=int, default=20)
+    parser.add_argument('--albums', type=int, default=5, help='albums per artist')
+    parser.add_argument('--tracks', type=int, default=10, help='tracks per album')
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes for the parallel scan')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--library', help='create (or reuse) the library here instead of a temporary directory')
+    parser.add_argument('--output', default='bench_results.json', help="result file ('-' for stdout)")
+    args = parser.parse_args()
+
+    params = vars(args).copy()
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        root = args.library or workdir
+        if not os.path.isdir(os.path.join(root, 'artist00000')):
+            t = time.perf_counter()
+            num_files = make_library(root, args.artists, args.albums, args.tracks, args.formats.split(','))
+            print('library: {} files created in {:.1f}s'.format(num_files, time.perf_counter() - t))
+        num_files = sum(len(updator.list_music_files(os.path.join(root, a, b)))
+                        for a in os.listdir(root) if os.path.isdir(os.path.join(root, a)) and not a.startswith('.')
+                        for b in os.listdir(os.path.join(root, a)) if os.path.isdir(os.path.join(root, a, b)))
+        results['files'] = num_files
+
+        # 初回はサムネイルの作成も含まれるので別に計測する
+        elapsed = run_update(root, incremental=False, jobs=1)
+        results['update_cold'] = {'seconds': elapsed, 'files_per_second': num_files / elapsed}
+        print('{:<22}: {:8.3f}s  {:10.1f} files/s'.format('update_cold', elapsed, num_files / elapsed))
+
+        # updator: 全ファイルの解析 (逐次・並列)、変更が無い場合の再スキャン
+        for name, kwargs in [('update_full_serial',   {'incremental': False, 'jobs': 1}),
+                             ('update_full_parallel', {'incremental': False, 'jobs': args.jobs}),
+                             ('update_incremental',   {'incremental': True,  'jobs': 1})]:
+            elapsed = best_of(args.repeat, lambda: run_update(root, **kwargs))
+            results[name] = {'seconds': elapsed, 'files_per_second': num_files / elapsed}
+            print('{:<22}: {:8.3f}s  {:10.1f} files/s'.format(name, elapsed, num_files / elapsed))
+
+        # ArtistList.load: 読み込み時間とメモリ使用量
+        for name in ['database.json', 'database.bin']:
+            path = os.path.join(root, name)
+            runs = [run_load(path) for i in range(args.repeat)]
+            elapsed = min(r[0] for r in runs)
+            results['load_' + name.split('.')[-1]] = {
+                'seconds': elapsed,
+                'resident_bytes': runs[-1][1],
+                'peak_bytes': max(r[2] for r in runs),
+                'file_bytes': os.path.getsize(path)
+            }
+            print('{:<22}: {:8.3f}s  peak {:8.1f} KB  resident {:8.1f} KB'.format(
+                'load ' + name, elapsed, max(r[2] for r in runs) / 1024, runs[-1][1] / 1024))
+
+    write_results(args.output, 'library', params, results)
@@ -0,0 +1,125 @@
+import os
+import sys
+import gc
+import json
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import Catalog
+from player import ArtistList
+from synthlib import make_catalog
+from benchutil import write_results
+
+
+# ------------------------------------------------------------------------------
+# 比較用: 以前の (1曲ごとに __dict__ を持つオブジェクトで曲を保持する) 実装
+class LegacySong:
+    def __init__(self, album):
+        self.__title = ''
+        self.__track_index = 0
+        self.__duration = 0
+        self.__filename = ''
+        self.__album = album
+
+    def load(self, obj):
+        self.__track_index = obj['index']
+        self.__title = obj['title']
+        self.__duration = obj['duration']
+        self.__filename = obj['filename']
+
+class LegacyAlbum:
+    def __init__(self, artist):
+        self.__id = 0
+        self.__songs = []
+        self.__title = ''
+        self.__total_time = 0
+        self.__year = 0
+        self.__directory = ''
+        self.__artist = artist
+
+    def load(self, obj):
+        self.__id = obj['id']
+        self.__title = obj['title']
+        self.__year = obj['year']
+        self.__directory = obj['directory']
+        self.__total_time = obj['totalTime']
+        for track in obj['tracks']:
+            song = LegacySong(self)
+            song.load(track)
+            self.__songs.append(song)
+
+class LegacyArtist:
+    def __init__(self):
+        self.__id = 0
+        self.__directory = ''
+        self.__albums = []
+        self.__name = ''
+
+    def load(self, obj):
+        self.__id = obj['id']
+        self.__name = obj['name']
+        self.__directory = obj['directory']
+        for a in obj['albums']:
+            album = LegacyAlbum(self)
+            album.load(a)
+            self.__albums.append(album)
+
+def load_legacy(path):
+    artists = []
+    with open(path, 'r') as fp:
+        for o in json.load(fp):
+            artist = LegacyArtist()
+            artist.load(o)
+            artists.append(artist)
+    return artists
+
+# ------------------------------------------------------------------------------
+def measure(loader):
+    gc.collect()
+    tracemalloc.start()
+    result = loader()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='memory usage of the loaded catalog')
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--min-ratio', type=float, default=2.0, help='required legacy/current ratio')
+    parser.add_argument('--output', help="result file ('-' for stdout)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        library = make_catalog(args.tracks)
+        json_path = os.path.join(workdir, 'database.json')
+        bin_path = os.path.join(workdir, 'database.bin')
+        with open(json_path, mode='w', encoding='utf-8') as fp:
+            json.dump(library, fp, ensure_ascii=False)
+        Catalog.from_json(library).write(bin_path)
+        del library
+
+        def load(path):
+            artist_list = ArtistList()
+            artist_list.load(path)
+            return artist_list
+
+        legacy = measure(lambda: load_legacy(json_path))
+        current_json = measure(lambda: load(json_path))
+        current_bin = measure(lambda: load(bin_path))
+
+    print('tracks                : {}'.format(args.tracks))
+    for name, size in [('legacy objects', legacy), ('current (json)', current_json), ('current (bin)', current_bin)]:
+        print('{:<22}: {:>8.1f} KB ({:.1f} bytes/track)'.format(name, size / 1024, size / args.tracks))
+    ratio = legacy / max(current_bin, current_json)
+    print('reduction             : {:.1f}x'.format(ratio))
+    if args.output:
+        write_results(args.output, 'memory', vars(args), {
+            'legacy_bytes': legacy, 'json_bytes': current_json, 'bin_bytes': current_bin, 'ratio': ratio
+        })
+    sys.exit(0 if ratio >= args.min_ratio else 1)
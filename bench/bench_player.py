@@ -0,0 +1,136 @@
+import os
+import sys
+import io
+import time
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from player import Player
+from fakempd import FakeMPDServer
+from benchutil import write_results
+
+
+# ------------------------------------------------------------------------------
+class FakeAlbum:
+    def __init__(self, name, num_tracks):
+        self.__playlist = ['{}/{:04}.mp3'.format(name, i) for i in range(num_tracks)]
+
+    def get_playlist(self):
+        return self.__playlist
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))]
+    return {'p50_ms': pick(0.5) * 1000, 'p95_ms': pick(0.95) * 1000, 'max_ms': samples[-1] * 1000}
+
+def wait_for(player, predicate, timeout=5.0):
+    # predicate(modified) が真になる通知が届くまで待ち、待った時間を返す
+    t = time.perf_counter()
+    while time.perf_counter() - t < timeout:
+        modified = player.get_modified()
+        if modified is None:
+            time.sleep(0.0005)
+        elif predicate(modified):
+            return time.perf_counter() - t
+    raise TimeoutError('no status update within {}s'.format(timeout))
+
+def drain(player):
+    while player.get_modified():
+        pass
+
+# ------------------------------------------------------------------------------
+def bench_commands(server, player, repeat):
+    # コマンドを呼んだスレッドが待たされる時間と、MPD に反映されるまでの時間
+    call, complete = [], []
+    for i in range(repeat):
+        t = time.perf_counter()
+        future = player.play(i % 10)
+        call.append(time.perf_counter() - t)
+        future.result()
+        complete.append(time.perf_counter() - t)
+    return {'call': percentiles(call), 'complete': percentiles(complete)}
+
+def bench_burst(server, player, taps):
+    # next を続けて押したときに MPD に送られるコマンド数
+    player.play(0).result()
+    drain(player)
+    before = server.state.commands
+    futures = [player.next() for i in range(taps)]
+    for future in futures:
+        future.result()
+    return {'taps': taps, 'server_commands': server.state.commands - before, 'final_song': server.state.song}
+
+def bench_status(server, player, repeat):
+    # MPD 側で曲が変わってから Player が通知するまでの時間
+    samples = []
+    for i in range(repeat):
+        drain(player)
+        song = (i % 9) + 1
+        with server.state.lock:
+            server.state.set_state('play', song)
+        samples.append(wait_for(player, lambda m: m.get('song') == song + 1))
+    return percentiles(samples)
+
+def bench_status_reads(server, player, repeat):
+    # コマンドの実行中に player.status を読む時間 (MPD の応答を待たされないこと)
+    samples = []
+    future = player.set_album(FakeAlbum('reads', 200))
+    while len(samples) < repeat * 100 or not future.done():
+        t = time.perf_counter()
+        player.status.song
+        samples.append(time.perf_counter() - t)
+    return dict(percentiles(samples), reads=len(samples))
+
+def bench_idle_traffic(server, player, seconds):
+    # 演奏中に何もしていないときに Player が MPD に送るコマンド数
+    drain(player)
+    before = server.state.commands
+    time.sleep(seconds)
+    return {'seconds': seconds, 'server_commands_per_sec': (server.state.commands - before) / seconds}
+
+def bench_set_album(server, player, num_tracks):
+    results = {}
+    for name, album in [('new', FakeAlbum('new', num_tracks)), ('same', None), ('other', FakeAlbum('other', num_tracks))]:
+        album = album or results['album']
+        before = server.state.commands
+        t = time.perf_counter()
+        player.set_album(album).result()
+        results[name] = {'ms': (time.perf_counter() - t) * 1000, 'server_commands': server.state.commands - before}
+        results['album'] = album
+    del results['album']
+    return results
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Player benchmark against a local fake MPD server')
+    parser.add_argument('--latency', type=float, default=0.005, help='simulated MPD response latency in seconds')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--taps', type=int, default=5, help='rapid next presses for the coalescing test')
+    parser.add_argument('--tracks', type=int, default=500, help='tracks in the set_album test playlist')
+    parser.add_argument('--idle', type=float, default=3.0, help='seconds to observe idle traffic')
+    parser.add_argument('--output', default='bench_results.json', help="result file ('-' for stdout)")
+    args = parser.parse_args()
+
+    server = FakeMPDServer(latency=args.latency).start()
+    Player.PORT = server.port
+    with contextlib.redirect_stdout(io.StringIO()):
+        player = Player()
+    try:
+        results = {}
+        results['set_album'] = bench_set_album(server, player, args.tracks)
+        player.set_album(FakeAlbum('bench', 10)).result()
+        results['commands'] = bench_commands(server, player, args.repeat)
+        results['burst'] = bench_burst(server, player, args.taps)
+        results['status'] = bench_status(server, player, args.repeat)
+        results['status_read'] = bench_status_reads(server, player, args.repeat)
+        results['idle'] = bench_idle_traffic(server, player, args.idle)
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            player.quit()
+        server.stop()
+
+    for name, result in results.items():
+        print('{:10} {}'.format(name, result))
+    write_results(args.output, 'player', vars(args), results)
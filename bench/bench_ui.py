@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# 画面の無い環境でも動くように、SDL のダミーのドライバを使う
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+from ui import TextAlign, Canvas, UIWidget, Desktop, Popup, Label, PaintBox, Button
+from view import NavigationView, ArtistListView, AlbumListView, PlaybackView
+from player import ArtistList, PlaybackState
+from synthlib import make_catalog
+from benchutil import write_results
+
+RES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'res')
+
+
+# ------------------------------------------------------------------------------
+class FakePlayer:
+    # view が参照する Player の一部だけを持つ (MPD には接続しない)
+    class Status:
+        state = PlaybackState.STOP
+        song = -1
+
+    status = Status()
+
+    def play(self, song):
+        pass
+
+    def stop(self):
+        pass
+
+    def toggle_pause(self):
+        pass
+
+    def next(self):
+        pass
+
+    def previous(self):
+        pass
+
+class FakeTouch:
+    # Popup が登録するリスナを受け取るだけ (タッチパネルは使わない)
+    def add_event_listener(self, listener):
+        pass
+
+    def remove_event_listener(self, listener):
+        pass
+
+class Counter:
+    # widget の draw、canvas の転送、画面の更新で転送した画素数を数える
+    # (FrameScheduler のカウンタが無い以前の版とも比べられるよう、メソッドを差し替えて数える)
+    def __init__(self):
+        self.draws = 0
+        self.blits = 0
+        self.pixels = 0
+        self.updates = 0
+        self.__drawing = set()
+        for cls in [UIWidget, Desktop, Popup, Label, PaintBox, Button,
+                    NavigationView, ArtistListView, AlbumListView, PlaybackView, MessagePopup]:
+            if 'draw' in cls.__dict__:
+                cls.draw = self.__count_draw(cls.__dict__['draw'])
+        blit = Canvas.blit
+        def count_blit(canvas, *args, **kwargs):
+            # 範囲外で転送しなかったもの (False) は数えない
+            result = blit(canvas, *args, **kwargs)
+            if result is not False:
+                self.blits += 1
+            return result
+        Canvas.blit = count_blit
+        update = pygame.display.update
+        def count_update(rects=None):
+            rects = [rects] if isinstance(rects, pygame.Rect) else (rects or [])
+            self.updates += 1
+            self.pixels += sum(pygame.Rect(r).width * pygame.Rect(r).height for r in rects)
+            return update(rects)
+        pygame.display.update = count_update
+
+    def __count_draw(self, draw):
+        # サブクラスの draw から super().draw() を呼んだ分は数えない
+        def count_draw(widget):
+            if widget.id in self.__drawing:
+                return draw(widget)
+            self.__drawing.add(widget.id)
+            self.draws += 1
+            try:
+                return draw(widget)
+            finally:
+                self.__drawing.discard(widget.id)
+        return count_draw
+
+    def snapshot(self):
+        return (self.draws, self.blits, self.pixels, self.updates)
+
+    def measure(self, proc):
+        # proc を実行し、次のフレームの描画までに増えた分を返す
+        before = self.snapshot()
+        proc()
+        UIWidget.frames.flush(force=True)
+        return dict(zip(['draws', 'blits', 'pixels', 'display_updates'],
+                        [a - b for a, b in zip(self.snapshot(), before)]))
+
+class MessagePopup(Popup):
+    def __init__(self):
+        super().__init__()
+        self.create((312, 150, 400, 300))
+        self.__label = Label(self)
+        self.__label.create((20, 20, 360, 40))
+        self.__label.canvas.set_font_size(20)
+        self.__label.alignment = TextAlign.MIDDLE
+        self.__label.text = 'benchmark'
+
+def configure_paths():
+    # 実機のパス (/home/pi/player/res) の代わりに、リポジトリの res を使う
+    Canvas.SSEG_PATH = os.path.join(RES_DIR, 'LED7SEG_Standard.ttf')
+    Canvas.ICON_PATH = os.path.join(RES_DIR, 'Material-Design-Iconic-Font.ttf')
+    Canvas.CODEPOINTS_PATH = os.path.join(RES_DIR, 'codepoints.json')
+    if not os.path.isfile(Canvas.FONT_PATH):
+        # 日本語のフォントが無ければ pygame の標準のフォントで代用する
+        Canvas.FONT_PATH = os.path.join(os.path.dirname(pygame.__file__), 'freesansbold.ttf')
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='count widget draws, blits and pushed pixels per UI interaction')
+    parser.add_argument('--tracks', type=int, default=20, help='tracks per album')
+    parser.add_argument('--ticks', type=int, default=10, help='elapsed-time updates to measure')
+    parser.add_argument('--output', default='bench_results.json', help="result file ('-' for stdout)")
+    args = parser.parse_args()
+
+    configure_paths()
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'database.json')
+        with open(path, mode='w', encoding='utf-8') as fp:
+            json.dump(make_catalog(args.tracks * 20, tracks_per_album=args.tracks), fp)
+        artist_list = ArtistList()
+        artist_list.load(path)
+        artist_list.wait()
+
+    player = FakePlayer()
+    desktop = Desktop()
+    navigation_view = NavigationView(desktop, player)
+    artist_listview = ArtistListView(desktop, artist_list)
+    artist_listview.hide()
+    album_listview = AlbumListView(desktop)
+    album_listview.hide()
+    playback_view = PlaybackView(desktop, player)
+    Popup.initialize(FakeTouch(), desktop)
+    popup = MessagePopup()
+    counter = Counter()
+    album = artist_list.artists[0].albums[0]
+
+    def startup():
+        playback_view.set_album(album)
+        desktop.show()
+
+    def tick():
+        for i in range(args.ticks):
+            navigation_view.update({'elapsed': i})
+            UIWidget.frames.flush(force=True)
+
+    def touch_panel():
+        pos = playback_view.client_to_screen((100, 120))
+        desktop.handle_touch_event({'touched': True, 'pos': pos})
+        UIWidget.frames.flush(force=True)
+        desktop.handle_touch_event({'touched': False, 'pos': pos})
+
+    def show_artist_list():
+        artist_listview.set_page(current_artist=album.artist)
+        playback_view.hide()
+        artist_listview.show()
+
+    def show_playback():
+        artist_listview.hide()
+        playback_view.show()
+
+    results = {}
+    for name, proc in [('startup', startup),
+                       ('elapsed_tick', tick),
+                       ('scroll_down', lambda: playback_view.scroll_down(None)),
+                       ('touch_panel', touch_panel),
+                       ('show_artist_list', show_artist_list),
+                       ('back_to_playback', show_playback),
+                       ('popup_show', popup.show),
+                       ('popup_close', popup.hide),
+                       ('desktop_refresh', desktop.refresh)]:
+        results[name] = counter.measure(proc)
+        print('{:18} {}'.format(name, results[name]))
+    Popup.terminate()
+    write_results(args.output, 'ui', vars(args), results)
@@ -0,0 +1,36 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path, name, params, results):
+    # 結果を JSON で書き出す (バージョン間で比較できるよう、リビジョンと実行環境も記録する)
+    obj = {
+        'benchmark': name,
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'results': results
+    }
+    if path == '-':
+        json.dump(obj, sys.stdout, indent=4)
+        print()
+        return
+    with open(path, mode='w', encoding='utf-8') as fp:
+        json.dump(obj, fp, indent=4)
+    print('results written to {}'.format(path))
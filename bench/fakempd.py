@@ -0,0 +1,327 @@
+import sys
+import time
+import socket
+import threading
+import socketserver
+
+
+# ------------------------------------------------------------------------------
+# Player のテスト・ベンチマーク用の MPD の代わりのサーバ
+#   status, currentsong, playlistinfo, plchanges, idle, add/addid, delete, clear, play, pause, stop,
+#   next, previous, setvol, update, ping と command_list に対応する (曲の再生はしない)
+#   latency で応答の遅延を、failures で ACK を返すコマンドを、disconnect_next / drop_connections で
+#   切断を模擬できる
+# ------------------------------------------------------------------------------
+class FakeMPDState:
+    # MPD の状態 (プレイリストと再生状態)。経過時間は実時間で進める
+    def __init__(self, song_duration=180.0):
+        self.song_duration = song_duration
+        self.playlist = []          # (id, url)
+        self.next_id = 1
+        self.version = 1
+        self.changes = {}           # 曲の位置 -> 変更されたバージョン
+        self.state = 'stop'
+        self.song = 0
+        self.elapsed = 0.0
+        self.started = None         # 演奏を開始した時刻 (monotonic)
+        self.updating_db = 0
+        self.volume = 50
+        self.lock = threading.Condition()
+        self.events = []            # 接続ごとの、まだ idle で返していない変化したサブシステムの集合
+        self.commands = 0
+
+    def current_elapsed(self):
+        if self.state == 'play' and self.started is not None:
+            return self.elapsed + time.monotonic() - self.started
+        return self.elapsed
+
+    def notify(self, *subsystems):
+        for pending in self.events:
+            pending.update(subsystems)
+        self.lock.notify_all()
+
+    def set_state(self, state, song=None):
+        self.elapsed = 0.0 if song is not None or state == 'stop' else self.current_elapsed()
+        if song is not None:
+            self.song = song
+        self.state = state
+        self.started = time.monotonic() if state == 'play' else None
+        self.notify('player')
+
+    def playlist_changed(self, first):
+        self.version += 1
+        for i in range(first, len(self.playlist)):
+            self.changes[i] = self.version
+        for i in list(self.changes):
+            if i >= len(self.playlist):
+                del self.changes[i]
+        self.notify('playlist')
+
+
+# ------------------------------------------------------------------------------
+class FakeMPDError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeMPDHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        state = server.state
+        server.connections.add(self.connection)
+        # MPD と同じく、idle を待っていない間に起きた変化も次の idle で返す
+        self.pending = set()
+        with state.lock:
+            state.events.append(self.pending)
+        try:
+            self.serve(server, state)
+        except OSError:
+            pass
+        finally:
+            with state.lock:
+                state.events.remove(self.pending)
+            server.connections.discard(self.connection)
+
+    def serve(self, server, state):
+        self.wfile.write(b'OK MPD 0.23.5\n')
+        command_list = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8').rstrip('\n')
+            if line in ['command_list_begin', 'command_list_ok_begin']:
+                command_list = (line == 'command_list_ok_begin', [])
+                continue
+            if command_list is not None and line != 'command_list_end':
+                command_list[1].append(line)
+                continue
+            if server.disconnect_next:
+                server.disconnect_next = False
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            if line == 'noidle':
+                continue
+            lines = command_list[1] if command_list else [line]
+            list_ok = command_list[0] if command_list else False
+            command_list = None
+            response = []
+            try:
+                for n, cmd in enumerate(lines):
+                    name, args = self.split(cmd)
+                    if name == 'noidle':
+                        # idle 中でなければ MPD は noidle に応答しない
+                        continue
+                    if name in server.failures:
+                        raise FakeMPDError(5, 'injected failure')
+                    if name == 'idle':
+                        response += self.idle(args)
+                    else:
+                        response += self.execute(name, args)
+                    if list_ok:
+                        response.append('list_OK')
+                response.append('OK')
+            except FakeMPDError as e:
+                response.append('ACK [{}@{}] {{{}}} {}'.format(e.code, n, name, e))
+            self.wfile.write(('\n'.join(response) + '\n').encode('utf-8'))
+
+    @staticmethod
+    def split(line):
+        words = []
+        pos = 0
+        while pos < len(line):
+            if line[pos] == ' ':
+                pos += 1
+            elif line[pos] == '"':
+                end = pos + 1
+                word = ''
+                while line[end] != '"':
+                    if line[end] == '\\':
+                        end += 1
+                    word += line[end]
+                    end += 1
+                words.append(word)
+                pos = end + 1
+            else:
+                end = line.find(' ', pos)
+                end = len(line) if end < 0 else end
+                words.append(line[pos:end])
+                pos = end
+        return words[0], words[1:]
+
+    def idle(self, args):
+        state = self.server.state
+        pending = self.pending
+        subsystems = set(args) if args else None
+        changed = lambda: pending & subsystems if subsystems else set(pending)
+        self.connection.setblocking(False)
+        try:
+            with state.lock:
+                while not changed():
+                    state.lock.wait(0.05)
+                    # noidle が届いていれば待つのをやめる
+                    try:
+                        data = self.connection.recv(64, socket.MSG_PEEK)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        return []
+                    self.rfile.readline()
+                    break
+                result = changed()
+                pending -= result
+        finally:
+            self.connection.setblocking(True)
+        return ['changed: {}'.format(s) for s in sorted(result)]
+
+    def execute(self, name, args):
+        state = self.server.state
+        with state.lock:
+            state.commands += 1
+            if name == 'ping':
+                return []
+            if name == 'status':
+                result = ['volume: {}'.format(state.volume), 'repeat: 0', 'random: 0', 'single: 0', 'consume: 0',
+                          'playlist: {}'.format(state.version), 'playlistlength: {}'.format(len(state.playlist)),
+                          'state: {}'.format(state.state)]
+                if state.state != 'stop' and state.playlist:
+                    result += ['song: {}'.format(state.song), 'songid: {}'.format(state.playlist[state.song][0]),
+                               'elapsed: {:.3f}'.format(state.current_elapsed()),
+                               'duration: {:.3f}'.format(state.song_duration)]
+                if state.updating_db:
+                    result.append('updating_db: {}'.format(state.updating_db))
+                return result
+            if name == 'currentsong':
+                if state.state == 'stop' or not state.playlist:
+                    return []
+                return self.song_info(state.song)
+            if name in ['playlistinfo', 'playlistid']:
+                return [line for i in range(len(state.playlist)) for line in self.song_info(i)]
+            if name == 'plchanges':
+                version = int(args[0])
+                return [line for i in range(len(state.playlist))
+                        if state.changes.get(i, 0) > version for line in self.song_info(i)]
+            if name in ['add', 'addid']:
+                song_id = state.next_id
+                state.next_id += 1
+                state.playlist.append((song_id, args[0]))
+                state.playlist_changed(len(state.playlist) - 1)
+                return ['Id: {}'.format(song_id)] if name == 'addid' else []
+            if name == 'delete':
+                first, last = self.range(args[0], len(state.playlist))
+                del state.playlist[first:last]
+                if state.song >= len(state.playlist):
+                    state.set_state('stop', 0)
+                state.playlist_changed(first)
+                return []
+            if name == 'clear':
+                state.playlist = []
+                state.playlist_changed(0)
+                state.set_state('stop', 0)
+                return []
+            if name == 'play':
+                song = int(args[0]) if args else state.song
+                if not 0 <= song < len(state.playlist):
+                    raise FakeMPDError(2, 'Bad song index')
+                if not args and state.state == 'pause':
+                    state.set_state('play')
+                else:
+                    state.set_state('play', song)
+                return []
+            if name == 'pause':
+                if state.state != 'stop':
+                    paused = (args[0] == '1') if args else state.state == 'play'
+                    state.set_state('pause' if paused else 'play')
+                return []
+            if name == 'stop':
+                state.set_state('stop')
+                return []
+            if name in ['next', 'previous']:
+                # MPD と同じく、一時停止中でも移動先の曲から演奏を始める (最初の曲での previous はその曲の先頭から)
+                if state.state != 'stop':
+                    song = state.song + 1 if name == 'next' else max(0, state.song - 1)
+                    if song < len(state.playlist):
+                        state.set_state('play', song)
+                    else:
+                        state.set_state('stop', 0)
+                return []
+            if name == 'setvol':
+                state.volume = int(args[0])
+                state.notify('mixer')
+                return []
+            if name == 'update':
+                state.updating_db += 1
+                state.notify('update')
+
+                def finish():
+                    with state.lock:
+                        state.updating_db = 0
+                        state.notify('update', 'database')
+                threading.Timer(self.server.update_time, finish).start()
+                return ['updating_db: {}'.format(state.updating_db)]
+            raise FakeMPDError(5, 'unknown command "{}"'.format(name))
+
+    def song_info(self, i):
+        song_id, url = self.server.state.playlist[i]
+        return ['file: {}'.format(url), 'Time: {}'.format(int(self.server.state.song_duration)),
+                'Pos: {}'.format(i), 'Id: {}'.format(song_id)]
+
+    @staticmethod
+    def range(arg, length):
+        if ':' in arg:
+            first, last = arg.split(':')
+            return int(first), int(last) if last else length
+        return int(arg), int(arg) + 1
+
+
+# ------------------------------------------------------------------------------
+class FakeMPDServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), latency=0.0, song_duration=180.0, update_time=0.5):
+        super().__init__(address, FakeMPDHandler)
+        self.state = FakeMPDState(song_duration)
+        self.latency = latency          # コマンドの応答を返すまでの遅延 (秒)
+        self.failures = set()           # ACK を返すコマンド
+        self.disconnect_next = False    # 次のコマンドで接続を切る
+        self.update_time = update_time
+        self.connections = set()
+        self.__thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def drop_connections(self):
+        # 接続中のクライアントを全て切断する (MPD の再起動や connection_timeout を模擬する)
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    # python3 bench/fakempd.py [ポート番号] [遅延(秒)]   : Player.PORT をこのポートにすれば実機の代わりに使える
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6600
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = FakeMPDServer(('localhost', port), latency=latency)
+    print('fake MPD listening on port {}'.format(server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
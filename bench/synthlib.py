@@ -0,0 +1,139 @@
+import os
+import sys
+import struct
+import random
+from PIL import Image
+from mutagen.id3 import ID3, TPE1, TALB, TIT2, TDRC, TRCK
+from mutagen.flac import FLAC
+from mutagen.mp4 import MP4
+
+
+# ------------------------------------------------------------------------------
+# ベンチマーク用の架空のライブラリを作成する
+#
+#   <root>/<アーティスト>/artist.png
+#   <root>/<アーティスト>/<アルバム>/coverart.png
+#   <root>/<アーティスト>/<アルバム>/01.mp3 (.flac, .m4a)
+#
+# 音声データは無音だが、mutagen で解析できる(updator で読み込める)正しい形式のファイルを作る
+# ------------------------------------------------------------------------------
+FORMATS = ['mp3', 'flac', 'm4a']
+
+# MPEG1 Layer III 128kbps 44.1kHz の無音フレーム (1フレームが 417 バイト、約 26ms)
+MP3_FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+def write_mp3(path, tags, seconds):
+    with open(path, mode='wb') as fp:
+        fp.write(MP3_FRAME * max(1, round(seconds * MP3_FRAMES_PER_SECOND)))
+    id3 = ID3()
+    id3.add(TPE1(encoding=3, text=tags['artist']))
+    id3.add(TALB(encoding=3, text=tags['album']))
+    id3.add(TIT2(encoding=3, text=tags['title']))
+    id3.add(TDRC(encoding=3, text=str(tags['year'])))
+    id3.add(TRCK(encoding=3, text='{}/{}'.format(tags['index'], tags['total'])))
+    id3.save(path)
+
+def write_flac(path, tags, seconds):
+    # STREAMINFO だけを持つ FLAC ファイル (フレームは無い)
+    rate, channels, bits = 44100, 2, 16
+    samples = seconds * rate
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    info += ((rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples).to_bytes(8, 'big')
+    info += b'\x00' * 16
+    with open(path, mode='wb') as fp:
+        fp.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info)
+    f = FLAC(path)
+    f['artist'] = tags['artist']
+    f['album'] = tags['album']
+    f['title'] = tags['title']
+    f['date'] = str(tags['year'])
+    f['tracknumber'] = str(tags['index'])
+    f.save()
+
+def atom(name, payload):
+    return struct.pack('>I4s', 8 + len(payload), name) + payload
+
+def write_m4a(path, tags, seconds):
+    # 音声トラックのヘッダだけを持つ MP4 ファイル (サンプルは無い)
+    timescale = 44100
+    mvhd = struct.pack('>IIIII', 0, 0, 0, timescale, seconds * timescale) + b'\x00' * 80
+    mdhd = struct.pack('>IIIIIHH', 0, 0, 0, timescale, seconds * timescale, 0x55c4, 0)
+    hdlr = struct.pack('>II4s', 0, 0, b'soun') + b'\x00' * 12 + b'\x00'
+    moov = atom(b'moov', atom(b'mvhd', mvhd) + atom(b'trak', atom(b'mdia', atom(b'mdhd', mdhd) + atom(b'hdlr', hdlr))))
+    with open(path, mode='wb') as fp:
+        fp.write(atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom') + moov)
+    f = MP4(path)
+    f['\xa9ART'] = tags['artist']
+    f['\xa9alb'] = tags['album']
+    f['\xa9nam'] = tags['title']
+    f['\xa9day'] = str(tags['year'])
+    f['trkn'] = [(tags['index'], tags['total'])]
+    f.save()
+
+WRITERS = {'mp3': write_mp3, 'flac': write_flac, 'm4a': write_m4a}
+
+def write_png(path, size, seed):
+    rnd = random.Random(repr(seed))
+    color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+    Image.new('RGB', size, color).save(path)
+
+def make_library(root, num_artists=10, albums_per_artist=5, tracks_per_album=10, formats=FORMATS, image_size=(600, 600), seed=0):
+    # 作成した曲ファイルの数を返す
+    rnd = random.Random(seed)
+    count = 0
+    for a in range(num_artists):
+        artist_dir = os.path.join(root, 'artist{:05}'.format(a))
+        os.makedirs(artist_dir, exist_ok=True)
+        write_png(os.path.join(artist_dir, 'artist.png'), image_size, (seed, a))
+        for b in range(albums_per_artist):
+            album_dir = os.path.join(artist_dir, 'album{:03}'.format(b))
+            os.makedirs(album_dir, exist_ok=True)
+            write_png(os.path.join(album_dir, 'coverart.png'), image_size, (seed, a, b))
+            fmt = formats[(a * albums_per_artist + b) % len(formats)]
+            for t in range(tracks_per_album):
+                tags = {
+                    'artist': 'Artist {:05}'.format(a),
+                    'album': 'Album {:05}-{:03}'.format(a, b),
+                    'title': 'Song {} of album {:05}-{:03}'.format(t + 1, a, b),
+                    'year': 1970 + rnd.randrange(50),
+                    'index': t + 1,
+                    'total': tracks_per_album
+                }
+                path = os.path.join(album_dir, '{:02}.{}'.format(t + 1, fmt))
+                WRITERS[fmt](path, tags, 1 + rnd.randrange(4))
+                count += 1
+    return count
+
+# ------------------------------------------------------------------------------
+def make_catalog(num_tracks, tracks_per_album=10, albums_per_artist=10):
+    # updator が出力するのと同じ構造の (database.json に相当する) 架空のライブラリを作成する
+    library = []
+    num_albums = (num_tracks + tracks_per_album - 1) // tracks_per_album
+    for a in range((num_albums + albums_per_artist - 1) // albums_per_artist):
+        artist_id = (a + 1) * 100
+        artist = {'id': artist_id, 'name': 'Artist {:05}'.format(a), 'directory': 'artist{:05}'.format(a), 'albums': []}
+        for b in range(min(albums_per_artist, num_albums - a * albums_per_artist)):
+            album = {'id': artist_id + b + 1, 'title': 'Album {:05}-{:02}'.format(a, b), 'year': 1970 + b,
+                     'directory': 'album{:02}'.format(b), 'totalTime': 0, 'tracks': []}
+            for t in range(min(tracks_per_album, num_tracks - (a * albums_per_artist + b) * tracks_per_album)):
+                album['tracks'].append({
+                    'filename': '{:02}.mp3'.format(t + 1),
+                    'duration': 180 + (t * 7) % 120,
+                    'artist': artist['name'],
+                    'album': album['title'],
+                    'title': 'Song {} of album {:05}-{:02}'.format(t + 1, a, b),
+                    'year': album['year'],
+                    'index': t + 1
+                })
+            album['totalTime'] = sum(t['duration'] for t in album['tracks'])
+            artist['albums'].append(album)
+        library.append(artist)
+    return library
+
+
+if __name__ == '__main__':
+    # python3 bench/synthlib.py <出力先> [アーティスト数] [アーティストあたりのアルバム数] [アルバムあたりの曲数]
+    args = [int(v) for v in sys.argv[2:]]
+    n = make_library(sys.argv[1], *args)
+    print('{} files created in {}'.format(n, sys.argv[1]))
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import struct
+from array import array
+
+
+# ------------------------------------------------------------------------------
+# バイナリ形式のカタログ (database.bin)
+#
+#   ヘッダ  : magic(4) version(H) reserved(H) 文字列数(I) 文字列領域のバイト数(I) アーティスト数(I) アルバム数(I) 曲数(I)
+#   文字列  : 各文字列の開始位置(I)を 文字列数+1 個並べたものと、UTF-8 の文字列を連結したもの
+#             (同じ文字列は1回だけ格納する)
+#   以降は各フィールドを列ごとに並べた固定長の配列 (リトルエンディアン)
+#     アーティスト : id, name, directory, num_albums
+#     アルバム     : id, title, directory, year, total_time, num_tracks
+#     曲           : filename, title, duration, index, artist, album, year
+#   name/title/directory/filename は文字列領域の番号、num_albums/num_tracks は
+#   直前のアーティスト(アルバム)の続きから何件が自分のものかを示す
+#   曲の artist/album/year はタグの値をそのまま持つ (アルバムのものと異なる場合があるので、JSON に戻したときに失われないように)
+# ------------------------------------------------------------------------------
+class Catalog:
+    MAGIC = b'RMPC'
+    VERSION = 3
+    HEADER = struct.Struct('<4sHHIIIII')
+
+    ARTIST_COLUMNS = [('id', 'I'), ('name', 'I'), ('directory', 'I'), ('num_albums', 'I')]
+    ALBUM_COLUMNS  = [('id', 'I'), ('title', 'I'), ('directory', 'I'), ('year', 'H'), ('total_time', 'I'), ('num_tracks', 'I')]
+    TRACK_COLUMNS  = [('filename', 'I'), ('title', 'I'), ('duration', 'I'), ('index', 'H'),
+                      ('artist', 'I'), ('album', 'I'), ('year', 'H')]
+
+    def __init__(self):
+        self.string_data = b''                  # 全ての文字列を UTF-8 で連結したもの
+        self.string_offsets = array('I', [0])   # 各文字列の string_data 中の開始位置 (末尾に全体の長さ)
+        self.artists = {name: array(code) for name, code in Catalog.ARTIST_COLUMNS}
+        self.albums  = {name: array(code) for name, code in Catalog.ALBUM_COLUMNS}
+        self.tracks  = {name: array(code) for name, code in Catalog.TRACK_COLUMNS}
+
+    @property
+    def num_artists(self):
+        return len(self.artists['id'])
+
+    @property
+    def num_albums(self):
+        return len(self.albums['id'])
+
+    @property
+    def num_tracks(self):
+        return len(self.tracks['index'])
+
+    @property
+    def num_strings(self):
+        return len(self.string_offsets) - 1
+
+    @property
+    def strings(self):
+        return [self.string(i) for i in range(self.num_strings)]
+
+    def string(self, n):
+        return self.string_data[self.string_offsets[n]:self.string_offsets[n+1]].decode('utf-8')
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def from_json(cls, obj):
+        # database.json と同じ構造のリストからカタログを作成する
+        catalog = cls()
+        string_ids = {}
+        string_data = bytearray()
+
+        def intern(s):
+            sid = string_ids.get(s)
+            if sid is None:
+                sid = string_ids[s] = len(string_ids)
+                string_data.extend(s.encode('utf-8'))
+                catalog.string_offsets.append(len(string_data))
+            return sid
+
+        artists, albums, tracks = catalog.artists, catalog.albums, catalog.tracks
+        for a in obj:
+            artists['id'].append(a['id'])
+            artists['name'].append(intern(a['name']))
+            artists['directory'].append(intern(a['directory']))
+            artists['num_albums'].append(len(a['albums']))
+            for b in a['albums']:
+                albums['id'].append(b['id'])
+                albums['title'].append(intern(b['title']))
+                albums['directory'].append(intern(b['directory']))
+                albums['year'].append(b['year'])
+                albums['total_time'].append(b['totalTime'])
+                albums['num_tracks'].append(len(b['tracks']))
+                for t in b['tracks']:
+                    tracks['filename'].append(intern(t['filename']))
+                    tracks['title'].append(intern(t['title']))
+                    tracks['duration'].append(t['duration'])
+                    tracks['index'].append(t['index'])
+                    tracks['artist'].append(intern(t['artist']))
+                    tracks['album'].append(intern(t['album']))
+                    tracks['year'].append(t['year'])
+        catalog.string_data = bytes(string_data)
+        return catalog
+
+    def to_json(self):
+        # database.json と同じ構造に戻す (エクスポート用。from_json に渡したものと同じになる)
+        strings = self.strings
+        result = []
+        first_album = first_track = 0
+        for i in range(self.num_artists):
+            artist = {
+                'id': self.artists['id'][i],
+                'name': strings[self.artists['name'][i]],
+                'directory': strings[self.artists['directory'][i]],
+                'albums': []
+            }
+            for b in range(first_album, first_album + self.artists['num_albums'][i]):
+                album = {
+                    'id': self.albums['id'][b],
+                    'title': strings[self.albums['title'][b]],
+                    'year': self.albums['year'][b],
+                    'directory': strings[self.albums['directory'][b]],
+                    'totalTime': self.albums['total_time'][b],
+                    'tracks': []
+                }
+                for t in range(first_track, first_track + self.albums['num_tracks'][b]):
+                    album['tracks'].append({
+                        'filename': strings[self.tracks['filename'][t]],
+                        'duration': self.tracks['duration'][t],
+                        'artist': strings[self.tracks['artist'][t]],
+                        'album': strings[self.tracks['album'][t]],
+                        'title': strings[self.tracks['title'][t]],
+                        'year': self.tracks['year'][t],
+                        'index': self.tracks['index'][t]
+                    })
+                first_track += len(album['tracks'])
+                artist['albums'].append(album)
+            first_album += len(artist['albums'])
+            result.append(artist)
+        return result
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def load(cls, path):
+        # database.json / database.bin のどちらからでも読み込む
+        # 古い版の database.bin であれば、同じ場所の database.json から読み込む
+        base, ext = os.path.splitext(path)
+        if ext.lower() != '.json':
+            try:
+                return cls.read(path)
+            except ValueError:
+                if not os.path.isfile(base + '.json'):
+                    raise
+                path = base + '.json'
+        with open(path, mode='r', encoding='utf-8') as fp:
+            return cls.from_json(json.load(fp))
+
+    @classmethod
+    def read(cls, path):
+        with open(path, mode='rb') as fp:
+            data = fp.read()
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, _, n_strings, string_bytes, n_artists, n_albums, n_tracks = Catalog.HEADER.unpack_from(data, 0)
+        if magic != Catalog.MAGIC or version != Catalog.VERSION:
+            raise ValueError('not a catalog file (version {})'.format(version))
+        catalog = cls()
+        pos = Catalog.HEADER.size
+        catalog.string_offsets = cls.__read_column(data, pos, 'I', n_strings + 1)
+        pos += catalog.string_offsets.itemsize * (n_strings + 1)
+        catalog.string_data = data[pos:pos+string_bytes]
+        pos += string_bytes
+        for columns, table, count in [(Catalog.ARTIST_COLUMNS, catalog.artists, n_artists),
+                                      (Catalog.ALBUM_COLUMNS,  catalog.albums,  n_albums),
+                                      (Catalog.TRACK_COLUMNS,  catalog.tracks,  n_tracks)]:
+            for name, code in columns:
+                table[name] = cls.__read_column(data, pos, code, count)
+                pos += table[name].itemsize * count
+        return catalog
+
+    @staticmethod
+    def __read_column(data, pos, code, count):
+        column = array(code)
+        column.frombytes(data[pos:pos+column.itemsize*count])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    @staticmethod
+    def __write_column(column):
+        if sys.byteorder == 'big':
+            column = array(column.typecode, column)
+            column.byteswap()
+        return column.tobytes()
+
+    def write(self, path):
+        with open(path, mode='wb') as fp:
+            fp.write(self.to_bytes())
+
+    def to_bytes(self):
+        chunks = [
+            Catalog.HEADER.pack(Catalog.MAGIC, Catalog.VERSION, 0, self.num_strings, len(self.string_data),
+                                self.num_artists, self.num_albums, self.num_tracks),
+            Catalog.__write_column(self.string_offsets),
+            self.string_data
+        ]
+        for columns, table in [(Catalog.ARTIST_COLUMNS, self.artists),
+                               (Catalog.ALBUM_COLUMNS,  self.albums),
+                               (Catalog.TRACK_COLUMNS,  self.tracks)]:
+            for name, code in columns:
+                chunks.append(Catalog.__write_column(table[name]))
+        return b''.join(chunks)
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    # python3 catalog.py database.bin database.json   : JSON 形式で書き出す
+    # python3 catalog.py database.json database.bin   : バイナリ形式に変換する
+    src, dst = sys.argv[1], sys.argv[2]
+    if src.endswith('.json'):
+        with open(src, mode='r', encoding='utf-8') as fp:
+            Catalog.from_json(json.load(fp)).write(dst)
+    else:
+        with open(dst, mode='w', encoding='utf-8') as fp:
+            json.dump(Catalog.read(src).to_json(), fp, indent=4, ensure_ascii=False)
@@ -0,0 +1,143 @@
+import time
+import socket
+import threading
+from mpd import MPDClient, CommandError, ConnectionError as MPDConnectionError
+
+
+# ------------------------------------------------------------------------------
+class MPDConnection:
+    # MPD への1本の接続。切断されていれば次のコマンドの実行時に接続し直す
+    # 接続に失敗した場合は、失敗するたびに再接続までの間隔を倍にする (MIN_BACKOFF 〜 MAX_BACKOFF 秒)
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, host, port, name, timeout=10):
+        self.__host = host
+        self.__port = port
+        self.__name = name
+        self.__timeout = timeout
+        self.__client = None
+        self.__lock = threading.Lock()
+        self.__failures = 0         # 連続して接続に失敗した回数
+        self.__retry_at = 0         # 次に接続を試みてよい時刻 (monotonic)
+        self.__last_error = None
+        self.__closed = threading.Event()   # close した後は接続し直さない
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def connected(self):
+        return self.__client is not None
+
+    @property
+    def healthy(self):
+        # 直近の接続・コマンドが失敗していなければ正常とする (まだ接続していない場合を含む)
+        return self.__failures == 0
+
+    @property
+    def health(self):
+        return {
+            'name': self.__name,
+            'connected': self.connected,
+            'failures': self.__failures,
+            'last_error': self.__last_error,
+            'retry_in': max(0.0, self.__retry_at - time.monotonic())
+        }
+
+    def execute(self, func, wait=False):
+        # func(client) を実行して結果を返す
+        # 再接続を待っている間は、wait が False ならすぐに ConnectionError とする (タッチ操作を待たせない)
+        # 確立していた接続が切れていた場合 (MPD の connection_timeout など) は、すぐに接続し直して1回だけやり直す
+        # 応答が不正だった場合 (ProtocolError) や func が想定外の例外で失敗した場合は、送受信がずれている
+        # (command_list の途中など) かもしれないので切断し、次のコマンドで接続し直す
+        self.__lock.acquire()
+        try:
+            reused = self.__client is not None
+            if not reused:
+                self.__connect(wait)
+            try:
+                return func(self.__client)
+            except CommandError:
+                raise
+            except (MPDConnectionError, OSError) as e:
+                self.__disconnect()
+                if not reused:
+                    self.__fail(e)
+                    raise
+            except Exception:
+                # ProtocolError など
+                self.__disconnect()
+                raise
+            self.__connect(wait)
+            try:
+                return func(self.__client)
+            except CommandError:
+                raise
+            except (MPDConnectionError, OSError) as e:
+                self.__disconnect()
+                self.__fail(e)
+                raise
+            except Exception:
+                self.__disconnect()
+                raise
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        # 別のスレッドが応答を待っている (idle など) 場合は、ソケットを閉じてそのスレッドを起こす
+        # (そのスレッドの execute は ConnectionError になり、接続し直さずに戻る)
+        self.__closed.set()
+        client = self.__client
+        sock = getattr(client, '_sock', None) if client is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.__lock.acquire()
+        try:
+            self.__disconnect()
+        finally:
+            self.__lock.release()
+
+    def __connect(self, wait):
+        if self.__closed.is_set():
+            raise MPDConnectionError('{}: closed'.format(self.__name))
+        delay = self.__retry_at - time.monotonic()
+        if delay > 0:
+            if not wait:
+                raise MPDConnectionError('{}: reconnecting in {:.1f}s ({})'.format(self.__name, delay, self.__last_error))
+            if self.__closed.wait(delay):
+                raise MPDConnectionError('{}: closed'.format(self.__name))
+        client = MPDClient()
+        client.timeout = self.__timeout
+        client.idletimeout = None
+        try:
+            client.connect(self.__host, self.__port)
+        except (MPDConnectionError, OSError) as e:
+            self.__fail(e)
+            raise
+        if self.__failures:
+            print('MPDConnection[{}]: reconnected after {} failures'.format(self.__name, self.__failures))
+        self.__client = client
+        self.__failures = 0
+        self.__retry_at = 0
+        self.__last_error = None
+
+    def __disconnect(self):
+        if self.__client is None:
+            return
+        try:
+            self.__client.disconnect()
+        except (MPDConnectionError, OSError):
+            pass
+        self.__client = None
+
+    def __fail(self, e):
+        self.__failures += 1
+        self.__last_error = str(e)
+        backoff = min(self.MAX_BACKOFF, self.MIN_BACKOFF * 2 ** (self.__failures - 1))
+        self.__retry_at = time.monotonic() + backoff
+        print('MPDConnection[{}]: {} (retry in {:.1f}s)'.format(self.__name, e, backoff))
@@ -4,19 +4,101 @@ import threading
 import queue
 import time
 import math
-from PIL import Image
-from mpd import MPDClient
+import bisect
+from array import array
+from mpd import MPDError, ConnectionError as MPDConnectionError
 from enum import Enum
+from concurrent.futures import Future
+from artwork import ImageCache, Thumbnail
+from catalog import Catalog
+from connection import MPDConnection
 
 
+# ------------------------------------------------------------------------------
+class TrackTable:
+    # 全ての曲の情報を列ごとの配列で保持する
+    # 曲名・ファイル名は UTF-8 で連結した文字列領域への番号で持ち、
+    # 同じ文字列 ("01.mp3" など) は1つだけ保持する
+    def __init__(self):
+        self.__text = bytearray()           # 文字列を UTF-8 で連結したもの
+        self.__offsets = array('I', [0])    # 各文字列の開始位置 (末尾に全体の長さ)
+        self.__string_ids = None            # 文字列 -> 番号 (追加するときだけ使う)
+        self.__titles = array('I')
+        self.__filenames = array('I')
+        self.__durations = array('I')
+        self.__indices = array('H')
+
+    def __len__(self):
+        return len(self.__indices)
+
+    def __string(self, sid):
+        return self.__text[self.__offsets[sid]:self.__offsets[sid+1]].decode('utf-8')
+
+    def __intern(self, s):
+        if self.__string_ids is None:
+            self.__string_ids = {self.__string(i): i for i in range(len(self.__offsets) - 1)}
+        sid = self.__string_ids.get(s)
+        if sid is None:
+            sid = self.__string_ids[s] = len(self.__offsets) - 1
+            if not isinstance(self.__text, bytearray):
+                self.__text = bytearray(self.__text)
+            self.__text.extend(s.encode('utf-8'))
+            self.__offsets.append(len(self.__text))
+        return sid
+
+    def shrink(self):
+        # 読み込みが終わったら、追加用の索引は捨ててしまう (必要になれば作り直す)
+        self.__string_ids = None
+
+    def append(self, obj):
+        # database.json の曲の情報を追加し、その行番号を返す
+        self.__titles.append(self.__intern(obj['title']))
+        self.__filenames.append(self.__intern(obj['filename']))
+        self.__durations.append(obj['duration'])
+        self.__indices.append(obj['index'])
+        return len(self.__indices) - 1
+
+    def extend_catalog(self, catalog):
+        # カタログの曲を全て追加し、先頭の曲の行番号を返す
+        base = len(self.__indices)
+        tracks = catalog.tracks
+        if len(self.__offsets) == 1:
+            # 空のときはカタログの文字列領域をそのまま使う
+            self.__text = catalog.string_data
+            self.__offsets = array('I', catalog.string_offsets)
+            self.__string_ids = None
+            self.__titles.extend(tracks['title'])
+            self.__filenames.extend(tracks['filename'])
+        else:
+            sids = {}
+            for i in set(tracks['title']) | set(tracks['filename']):
+                sids[i] = self.__intern(catalog.string(i))
+            self.__titles.extend(sids[i] for i in tracks['title'])
+            self.__filenames.extend(sids[i] for i in tracks['filename'])
+        self.__durations.extend(tracks['duration'])
+        self.__indices.extend(tracks['index'])
+        return base
+
+    def title(self, row):
+        return self.__string(self.__titles[row])
+
+    def filename(self, row):
+        return self.__string(self.__filenames[row])
+
+    def duration(self, row):
+        return self.__durations[row]
+
+    def track_index(self, row):
+        return self.__indices[row]
+
 # ------------------------------------------------------------------------------
 class Song:
-    def __init__(self, album):
-        self.__title = ''       # 曲名
-        self.__track_index = 0  # トラックNo. (1がアルバムの先頭の曲)
-        self.__duration = 0     # 曲の演奏時間(秒単位)
-        self.__filename = ''    # ファイル名
+    # TrackTable の1行を参照するだけの軽量なオブジェクト
+    __slots__ = ('__album', '__row')
+
+    def __init__(self, album, row):
         self.__album = album    # この曲が収録されているアルバム
+        self.__row = row        # TrackTable 中の行番号
 
     @property
     def album(self):
@@ -24,43 +106,40 @@ class Song:
 
     @property
     def filename(self):
-        return self.__filename
+        return self.__album.artist.tracks.filename(self.__row)
 
     @property
     def path(self):
-        return os.path.join(self.__album.path, self.__filename)
+        return os.path.join(self.__album.path, self.filename)
 
     @property
     def title(self):
-        return self.__title
+        return self.__album.artist.tracks.title(self.__row)
 
     @property
     def duration(self):
-        return self.__duration
+        return self.__album.artist.tracks.duration(self.__row)
 
     @property
     def track_index(self):
-        return self.__track_index
-
-    def load(self, obj):
-        self.__track_index = obj['index']
-        self.__title = obj['title']
-        self.__duration = obj['duration']
-        self.__filename = obj['filename']
+        # トラックNo. (1がアルバムの先頭の曲)
+        return self.__album.artist.tracks.track_index(self.__row)
 
 # ------------------------------------------------------------------------------
 class Album:
     IMAGE_SIZE = (240, 240)
 
+    __slots__ = ('__id', '__first_track', '__num_tracks', '__title', '__total_time', '__year', '__directory', '__artist')
+
     def __init__(self, artist):
         self.__id = 0           # アルバムID
-        self.__songs = []       # アルバムに収録されている曲のリスト
+        self.__first_track = 0  # アルバムの先頭の曲の TrackTable 中の行番号
+        self.__num_tracks = 0   # アルバムに収録されている曲数
         self.__title = ''       # アルバムタイトル
         self.__total_time = 0   # 総演奏時間（各曲の演奏時間の総和、秒単位）
         self.__year = 0         # アルバムの発売年（西暦）
         self.__directory = ''   # フォルダ名（"trespass" など。フルパスではなくそのアルバムの曲が格納されたディレクトリ名であることに注意）
         self.__artist = artist  # このアルバムを所有するアーティスト
-        self.__image = None     # カバーアート画像データ   
 
     @property
     def album_id(self):
@@ -84,11 +163,12 @@ class Album:
 
     @property
     def num_tracks(self):
-        return len(self.__songs)
+        return self.__num_tracks
 
     @property
     def songs(self):
-        return self.__songs
+        # アルバムに収録されている曲のリスト (参照するたびに作るので、1曲だけ使う場合は get_song を使う)
+        return [Song(self, row) for row in range(self.__first_track, self.__first_track + self.__num_tracks)]
 
     @property
     def total_time(self):
@@ -98,17 +178,28 @@ class Album:
     def year(self):
         return self.__year
 
+    @property
+    def image_path(self):
+        return os.path.join(self.path, 'coverart.png')
+
     @property
     def image(self):
-        return self.__image
+        # カバーアートは起動時には読み込まず、最初に参照されたときにキャッシュ経由で読み込む
+        return Artist.image_cache.get(self.image_path)
+
+    def get_thumbnail(self, size):
+        return Artist.load_thumbnail(self.image_path, size)
 
     def get_song(self, index):
-        return self.__songs[index]
+        if not 0 <= index < self.__num_tracks:
+            raise IndexError('song index out of range')
+        return Song(self, self.__first_track + index)
 
     def get_playlist(self):
+        tracks = self.__artist.tracks
         playlist = []
-        for song in self.__songs:
-            playlist.append(os.path.join(self.__artist.directory, self.__directory, song.filename))
+        for row in range(self.__first_track, self.__first_track + self.__num_tracks):
+            playlist.append(os.path.join(self.__artist.directory, self.__directory, tracks.filename(row)))
             # playlist.append(song.path)
         return playlist
 
@@ -118,26 +209,44 @@ class Album:
         self.__year = obj['year']
         self.__directory = obj['directory']
         self.__total_time = obj['totalTime']
+        tracks = self.__artist.tracks
+        self.__first_track = len(tracks)
         for track in obj['tracks']:
-            song = Song(self)
-            song.load(track)
-            self.__songs.append(song)
-        
-        image_path = os.path.join(self.path, 'coverart.png')
-        self.__image = Image.open(image_path).convert('RGB')
-        # self.__image = src.resize(size=Album.IMAGE_SIZE, resample=Image.BICUBIC)
+            tracks.append(track)
+        self.__num_tracks = len(obj['tracks'])
+
+    def load_catalog(self, catalog, n, first_track, base=0):
+        # n はカタログ中のアルバムの番号、first_track はこのアルバムの最初の曲の番号
+        # base はカタログの先頭の曲の TrackTable 中の行番号
+        albums = catalog.albums
+        self.__id = albums['id'][n]
+        self.__title = catalog.string(albums['title'][n])
+        self.__year = albums['year'][n]
+        self.__directory = catalog.string(albums['directory'][n])
+        self.__total_time = albums['total_time'][n]
+        self.__first_track = base + first_track
+        self.__num_tracks = albums['num_tracks'][n]
+        return first_track + self.__num_tracks
 
 # ------------------------------------------------------------------------------
 class Artist:
     ROOT_PATH = '/media/usb'
     IMAGE_SIZE = (180, 180)
 
-    def __init__(self):
+    # アーティスト画像・カバーアートで共有する LRU キャッシュ
+    # 予算(バイト数)は image_cache.budget で変更できる
+    image_cache = ImageCache()
+
+    __slots__ = ('__id', '__directory', '__albums', '__name', '__album_by_id', '__album_index', '__tracks')
+
+    def __init__(self, tracks=None):
+        self.__tracks = tracks if tracks is not None else TrackTable()  # 曲の情報 (ArtistList 全体で共有する)
         self.__id = 0           # アーティストID
         self.__directory = ''   # ディレクトリ名
         self.__albums = []      # アルバムのリスト
         self.__name = ''        # アーティスト名
-        self.__image = None     # アーティストの画像
+        self.__album_by_id = {} # アルバムID -> アルバム
+        self.__album_index = {} # アルバムID -> albums 中の位置
 
     @property
     def artist_id(self):
@@ -155,6 +264,10 @@ class Artist:
     def path(self):
         return Artist.ROOT_PATH + '/' + self.__directory
 
+    @property
+    def tracks(self):
+        return self.__tracks
+
     @property
     def num_albums(self):
         return len(self.__albums)
@@ -163,9 +276,29 @@ class Artist:
     def albums(self):
         return self.__albums
 
+    @property
+    def image_path(self):
+        return os.path.join(Artist.ROOT_PATH, self.__directory, 'artist.png')
+
     @property
     def image(self):
-        return self.__image
+        return Artist.image_cache.get(self.image_path)
+
+    def get_thumbnail(self, size):
+        return Artist.load_thumbnail(self.image_path, size)
+
+    @classmethod
+    def discard_images(cls, source):
+        # 画像が更新されたときに、キャッシュされている古い画像を捨てる
+        cls.image_cache.discard(source)
+        for size in Thumbnail.SIZES:
+            cls.image_cache.discard((source, size))
+
+    @classmethod
+    def load_thumbnail(cls, source, size):
+        # 縮小済みの画像(updator が作成したもの)をキャッシュ経由で取得する
+        thumbnail = Thumbnail(cls.ROOT_PATH)
+        return cls.image_cache.get((source, tuple(size)), lambda key: thumbnail.load(*key))
 
     def load(self, obj):
         self.__id = obj['id']
@@ -175,66 +308,201 @@ class Artist:
             album = Album(self)
             album.load(a)
             self.__albums.append(album)
-        image_path = os.path.join(Artist.ROOT_PATH, self.__directory, 'artist.png')
-        self.__image = Image.open(image_path).convert('RGB')
-        # self.__image = src.resize(size=Artist.IMAGE_SIZE, resample=Image.BICUBIC)
+        self.build_index()
+
+    def load_catalog(self, catalog, n, first_album, first_track, base=0):
+        artists = catalog.artists
+        self.__id = artists['id'][n]
+        self.__name = catalog.string(artists['name'][n])
+        self.__directory = catalog.string(artists['directory'][n])
+        for i in range(first_album, first_album + artists['num_albums'][n]):
+            album = Album(self)
+            first_track = album.load_catalog(catalog, i, first_track, base)
+            self.__albums.append(album)
+        self.build_index()
+        return first_album + artists['num_albums'][n], first_track
+
+    def build_index(self):
+        # ID による検索を定数時間で行うための索引を作成する
+        self.__album_by_id = {a.album_id: a for a in self.__albums}
+        self.__album_index = {a.album_id: i for i, a in enumerate(self.__albums)}
+
+    def put_album(self, obj):
+        # アルバムを追加する (同じIDのアルバムがあれば置き換える)
+        # updator と同じく、発売年・タイトルの順に並べる
+        album = Album(self)
+        album.load(obj)
+        self.__albums = [a for a in self.__albums if a.album_id != album.album_id]
+        keys = [(a.year, a.title) for a in self.__albums]
+        self.__albums.insert(bisect.bisect_left(keys, (album.year, album.title)), album)
+        self.build_index()
+        return album
+
+    def remove_album(self, album_id):
+        self.__albums = [a for a in self.__albums if a.album_id != album_id]
+        self.build_index()
 
     def get_index_of_album(self, target):
-        for i, a in enumerate(self.__albums):
-            if a.album_id == target.album_id:
-                return i
-        return -1
+        return self.__album_index.get(target.album_id, -1)
 
     def get_album_of_index(self, index):
         return self.__albums[index]
 
     def get_album_by_id(self, target_id):
-        return [a for a in self.__albums if a.album_id == target_id][0]
+        return self.__album_by_id[target_id]
 
     def find_album(self, target_id):
-        found = [a for a in self.__albums if a.album_id == target_id]
-        return found[0] if len(found) > 0 else self.__albums[0]
+        return self.__album_by_id.get(target_id) or self.__albums[0]
 
 # ------------------------------------------------------------------------------
 class ArtistList:
     def __init__(self):
         self.__artists = []
+        self.__tracks = TrackTable()    # 全アーティストの曲の情報
+        self.__artist_by_id = {}    # アーティストID -> アーティスト
+        self.__artist_index = {}    # アーティストID -> artists 中の位置
+        self.__album_by_id = {}     # アルバムID -> アルバム (全アーティスト分)
+        self.__loaded = True        # バックグラウンドでの読み込みが完了しているか
+        self.__thread = None
+        self.__version = 0          # 一覧が変化するたびに増える
 
     @property
     def num_artists(self):
         return len(self.__artists)
 
+    @property
+    def loaded(self):
+        return self.__loaded
+
+    @property
+    def version(self):
+        return self.__version
+
     @property
     def artists(self):
         return self.__artists
 
     def load(self, path):
+        # 拡張子が .json でなければ updator が作成したバイナリ形式のカタログとみなす
+        if os.path.splitext(path)[-1].lower() != '.json':
+            self.load_catalog(Catalog.read(path))
+            return
         with open(path, 'r') as fp:
             obj = json.load(fp)
             for o in obj:
-                artist = Artist()
+                artist = Artist(self.__tracks)
                 artist.load(o)
                 self.__artists.append(artist)
+        self.build_index()
+
+    def load_catalog(self, catalog, current_artist_id=None):
+        # current_artist_id を指定した場合は、そのアーティストだけを読み込んで直ちに戻り、
+        # 残りのアーティストはバックグラウンドで読み込む (読み込んだものから順に artists に追加される)
+        # 指定したアーティストが見つからなければ、先頭のアーティストを先に読み込む
+        base = self.__tracks.extend_catalog(catalog)
+        if current_artist_id is None or catalog.num_artists == 0:
+            self.__load_artists(catalog, base)
+            return
+
+        ids = catalog.artists['id']
+        n = ids.index(current_artist_id) if current_artist_id in ids else 0
+        first_album = sum(catalog.artists['num_albums'][:n])
+        first_track = sum(catalog.albums['num_tracks'][:first_album])
+        artist = Artist(self.__tracks)
+        artist.load_catalog(catalog, n, first_album, first_track, base)
+        self.__add_index(artist)
+        if n == 0:
+            self.__add(artist)
+
+        self.__loaded = False
+        self.__thread = threading.Thread(target=self.__load_artists, args=(catalog, base, (n, artist)), daemon=True)
+        self.__thread.start()
+
+    def wait(self):
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def __load_artists(self, catalog, base, preloaded=None):
+        first_album = first_track = 0
+        for n in range(catalog.num_artists):
+            if preloaded and n == preloaded[0]:
+                # 先に読み込んだアーティストをそのまま使う
+                artist = preloaded[1]
+                count = catalog.artists['num_albums'][n]
+                first_track += sum(catalog.albums['num_tracks'][first_album:first_album+count])
+                first_album += count
+                if n == 0:
+                    continue
+            else:
+                artist = Artist(self.__tracks)
+                first_album, first_track = artist.load_catalog(catalog, n, first_album, first_track, base)
+            self.__add(artist)
+        self.build_index()
+        self.__loaded = True
+        print('ArtistList: {} artists loaded'.format(len(self.__artists)))
+
+    def __add_index(self, artist):
+        self.__artist_by_id[artist.artist_id] = artist
+        for album in artist.albums:
+            self.__album_by_id[album.album_id] = album
+
+    def __add(self, artist):
+        # 索引を先に更新してから一覧に加える (一覧に見えているものは必ず索引で引ける)
+        self.__add_index(artist)
+        self.__artist_index[artist.artist_id] = len(self.__artists)
+        self.__artists.append(artist)
+        self.__version += 1
+
+    def build_index(self):
+        self.__tracks.shrink()
+        self.__artist_by_id = {a.artist_id: a for a in self.__artists}
+        self.__artist_index = {a.artist_id: i for i, a in enumerate(self.__artists)}
+        self.__album_by_id = {b.album_id: b for a in self.__artists for b in a.albums}
+
+    def apply_delta(self, delta):
+        # LibraryWatcher が通知する変更を反映する。変更されたアーティストを返す
+        #   {'type': 'album',  'artist': {'id', 'name', 'directory'}, 'album': (database.json のアルバム)}
+        #   {'type': 'remove', 'artist': アーティストID, 'album': アルバムID}
+        if delta['type'] == 'album':
+            artist = self.__artist_by_id.get(delta['artist']['id'])
+            if not artist:
+                artist = Artist(self.__tracks)
+                artist.load(dict(delta['artist'], albums=[]))
+                keys = [a.directory.lower() for a in self.__artists]
+                self.__artists.insert(bisect.bisect_left(keys, artist.directory.lower()), artist)
+            album = artist.put_album(delta['album'])
+            Artist.discard_images(album.image_path)
+        elif delta['type'] == 'remove':
+            artist = self.__artist_by_id.get(delta['artist'])
+            if not artist:
+                return None
+            artist.remove_album(delta['album'])
+            if artist.num_albums == 0:
+                self.__artists = [a for a in self.__artists if a.artist_id != artist.artist_id]
+        else:
+            return None
+        self.build_index()
+        self.__version += 1
+        return artist
 
     def find_album(self, target_album_id):
-        for artist in self.__artists:
-            album = artist.find_album(target_album_id)
-            if album:
-                return album
-        return None
+        return self.__album_by_id.get(target_album_id)
     
     def get_index_of_artist(self, target):
-        for i, a in enumerate(self.__artists):
-            if a.artist_id == target.artist_id:
-                return i
-        return -1
+        return self.__artist_index.get(target.artist_id, -1)
 
     def get_artist_of_index(self, index):
         return self.__artists[index]
 
     def get_artist_by_id(self, target_id):
-        found = [a for a in self.__artists if a.artist_id == target_id]
-        return found[0] if found else self.__artists[0]
+        return self.__artist_by_id.get(target_id) or self.__artists[0]
+
+    def find_saved_album(self, artist_id, album_id):
+        # config.json に保存したアルバムを探す
+        # LibraryWatcher が実行中に付けた ID はデータベースに残らないため、見つからなければ
+        # そのアーティストの先頭のアルバム (アーティストも無ければ先頭のアーティストのもの) を返す
+        return self.get_artist_by_id(artist_id).find_album(album_id)
 
 # ------------------------------------------------------------------------------
 class PlaybackState(Enum):
@@ -298,133 +566,382 @@ class PlayerStatus:
         return result
 
 
+# ------------------------------------------------------------------------------
+class StatusSnapshot:
+    # Player.status が返す、変更されない状態
+    # Player は状態が変わるたびに新しいスナップショットに差し替えるだけなので、読み出し側はロックを取らない
+    # sequence は差し替えるたびに増えるので、前回読んだものと比べれば変化したかどうかが分かる
+    __slots__ = ('__state', '__song', '__elapsed', '__updating', '__connected', '__sequence')
+
+    def __init__(self, status=None, connected=None, sequence=0):
+        status = status or PlayerStatus()
+        self.__state = status.state
+        self.__song = status.song
+        self.__elapsed = status.elapsed
+        self.__updating = status.updating
+        self.__connected = connected
+        self.__sequence = sequence
+
+    @property
+    def state(self):
+        return self.__state
+
+    @property
+    def song(self):
+        return self.__song
+
+    @property
+    def elapsed(self):
+        return self.__elapsed
+
+    @property
+    def updating(self):
+        return self.__updating
+
+    @property
+    def connected(self):
+        return self.__connected
+
+    @property
+    def sequence(self):
+        return self.__sequence
+
+# ------------------------------------------------------------------------------
+class PlayerCommand:
+    # Player のコマンドキューに積むコマンド。実行が終わると future に結果が設定される
+    __slots__ = ('__name', '__args', '__future')
+
+    def __init__(self, name, *args):
+        self.__name = name
+        self.__args = args
+        self.__future = Future()
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def args(self):
+        return self.__args
+
+    @property
+    def future(self):
+        return self.__future
+
+    # 送る内容が MPD の現在の状態 (status) によって変わるコマンド
+    STATE_DEPENDENT = ['toggle_pause', 'next', 'previous']
+
+    @staticmethod
+    def needs_status(commands):
+        # coalesce の前に status (と set_album ならプレイリスト) を取得する必要があるか
+        # 状態によって変わるコマンドが1つだけであれば、そのまま MPD に送るので status は要らない
+        # (1回のタップごとに status の往復が増えないように)
+        if any(c.name == 'set_album' for c in commands):
+            return True
+        return len([c for c in commands if c.name in PlayerCommand.STATE_DEPENDENT]) > 1
+
+    @staticmethod
+    def coalesce(commands, status, queue=None):
+        # 溜まっていたコマンドを、MPD に送るコマンド (名前, 引数) のリストにまとめる
+        #   - set_album より前のコマンドはプレイリストが置き換わるので送らない
+        #   - set_album は現在の MPD のプレイリスト (queue) と比べて、異なる部分だけを削除・追加する
+        #     (同じアルバムであれば何も送らないので、演奏も止まらない)
+        #   - 演奏中・一時停止中の next/previous は移動先の曲の play にし、連続した play/stop は最後のものだけを送る
+        #     (next を5回続けて押すと、5曲先の play が1回だけ送られる。最後の曲を過ぎると stop になる)
+        #   - 停止中の next/previous・toggle_pause は MPD では何もしないので送らない
+        #   - toggle_pause は、それまでのコマンドを実行した後の状態から pause 0/1 にし、打ち消し合うものは送らない
+        # status が None の場合は状態が分からないので、状態によって変わるコマンドはそのまま送る
+        # (状態はそれ以降 play/stop/set_album で分かるまで不明とする)
+        state = (status.get('state') or 'stop') if status is not None else None
+        song = int(status.get('song') or 0) if status is not None else None
+        length = int(status.get('playlistlength') or 0) if status is not None else None
+        last = max([i for i, c in enumerate(commands) if c.name == 'set_album'] or [0])
+        result = []
+        paused_from = None      # result の末尾が pause のとき、その pause の前の状態
+        for command in commands[last:]:
+            name, args = command.name, command.args
+            if name == 'set_album':
+                playlist = args[0]
+                current = queue or []
+                n = 0
+                while n < min(len(current), len(playlist)) and current[n] == playlist[n]:
+                    n += 1
+                if n == 0 and current:
+                    result.append(('clear', ()))
+                elif n < len(current):
+                    result.append(('delete', ((n, len(current)),)))
+                result += [('addid', (url,)) for url in playlist[n:]]
+                if n < len(current) or not current:
+                    state, song = 'stop', 0
+                length = len(playlist)
+                paused_from = None
+                continue
+            if name in PlayerCommand.STATE_DEPENDENT and state is None:
+                # 状態が分からない (MPD がそのときの状態で実行する)
+                result.append(('pause', ()) if name == 'toggle_pause' else (name, args))
+                song = None
+                paused_from = None
+                continue
+            if name in PlayerCommand.STATE_DEPENDENT and state == 'stop':
+                continue
+            if name == 'play':
+                state, song = 'play', args[0]
+            elif name == 'stop':
+                state, song = 'stop', 0
+            elif name == 'toggle_pause':
+                before = state
+                state = 'pause' if state == 'play' else 'play'
+                if result and result[-1][0] == 'pause' and paused_from is not None:
+                    # 直前の pause とまとめる。元の状態に戻るのであれば両方とも送らない
+                    result.pop()
+                    before, paused_from = paused_from, None
+                    if before == state:
+                        continue
+                result.append(('pause', (1 if state == 'pause' else 0,)))
+                paused_from = before
+                continue
+            elif name in ['next', 'previous']:
+                # MPD では一時停止中の next/previous も、移動先の曲から演奏を始める
+                if song is None or length is None:
+                    result.append((name, args))
+                    state, song = None, None
+                    paused_from = None
+                    continue
+                song = song + 1 if name == 'next' else max(0, song - 1)
+                if song < length:
+                    name, args = 'play', (song,)
+                    state = 'play'
+                else:
+                    name, args = 'stop', ()
+                    state, song = 'stop', 0
+            if result and name in ['play', 'stop'] and result[-1][0] in ['play', 'stop']:
+                result.pop()
+            result.append((name, args))
+            paused_from = None
+        return result
+
 # ------------------------------------------------------------------------------
 class Player:
+    # 状態の変化は idle で待ち受け、演奏中の経過時間は前回の status からの経過時間で求める
+    # idle で待っている間は他のコマンドを送れないので、コマンド用と待ち受け用に別々の接続を使う
+    IDLE_SUBSYSTEMS = ['player', 'mixer', 'playlist', 'options', 'update']
+    BATCH_SIZE = 256    # 1つの command_list で送るコマンドの最大数 (曲数の多いアルバムは分けて送る)
+    HOST = 'localhost'
+    PORT = 6600
+
     def __init__(self):
-        self.__client = MPDClient()
-        self.__client.timeout = 10
-        self.__client.idletimeout = None
-        self.__client.connect('localhost', 6600)
-        self.__status = PlayerStatus()
+        self.__command = MPDConnection(self.HOST, self.PORT, 'command')
+        self.__idle = MPDConnection(self.HOST, self.PORT, 'idle')
+        self.__status = PlayerStatus()     # update のスレッドだけが使う
+        self.__snapshot = StatusSnapshot()
+        self.__connected = None
         # self.__volume = None
-        self.__lock = threading.Lock()
         self.__queue = queue.Queue()
+        self.__notify = None
+        self.__received = threading.Condition()
+        self.__latest = None    # idle で受け取った最新の (status, 受け取った時刻)
         self.__terminated = False
+        # idle の応答はいつ届くか分からないので、待ち受けは専用のスレッドで行う
+        self.__idle_thread = threading.Thread(target=self.wait_idle, daemon=True)
+        self.__idle_thread.start()
         self.__thread = threading.Thread(target=self.update)
         self.__thread.start()
+        # 画面の操作を MPD の応答で待たせないよう、コマンドはキューに積んで別のスレッドで実行する
+        self.__commands = queue.Queue()
+        self.__queue_version = None     # 最後に取得した MPD のプレイリストのバージョン
+        self.__queue_files = []         # その時点のプレイリストのファイル名
+        self.__command_thread = threading.Thread(target=self.execute_commands)
+        self.__command_thread.start()
 
     @property
     def status(self):
-        s = PlayerStatus()
-        self.__lock.acquire()
-        try:
-            s.copy(self.__status)
-        except:
-            pass
-        finally:
-            self.__lock.release()
-        return s
+        return self.__snapshot
+
+    @property
+    def sequence(self):
+        return self.__snapshot.sequence
+
+    @property
+    def connected(self):
+        return self.__command.healthy and self.__idle.healthy
+
+    @property
+    def health(self):
+        return {'command': self.__command.health, 'idle': self.__idle.health}
 
     def quit(self):
         self.stop()
+        self.__commands.put(None)
+        self.__command_thread.join()
         self.__terminated = True
         self.__thread.join()
+        self.__command.close()
+        # idle で待っているスレッドは、接続を閉じると起きて終了する
+        self.__idle.close()
+        self.__idle_thread.join()
         print('Player: terminated')
 
+    def wait_idle(self):
+        # 状態が変化するまで MPD からの通知を待ち、変化したら status を取得し直す
+        # 接続が切れた場合は MPDConnection が間隔を空けながら接続し直す
+        while not self.__terminated:
+            try:
+                status = self.__idle.execute(lambda client: client.status(), wait=True)
+                self.__received.acquire()
+                try:
+                    self.__latest = (status, time.monotonic())
+                    self.__received.notify()
+                finally:
+                    self.__received.release()
+                self.__idle.execute(lambda client: client.idle(*self.IDLE_SUBSYSTEMS), wait=True)
+            except (MPDConnectionError, OSError):
+                pass
+            except MPDError as e:
+                # ACK や不正な応答 (不正な応答の場合は MPDConnection が切断して接続し直す)
+                print('Player: {}'.format(e))
+                time.sleep(1)
+
     def update(self):
         s = PlayerStatus()
+        status = {}
+        received = 0
         while not self.__terminated:
-            time.sleep(0.1)
-            self.__lock.acquire()
+            # 演奏中は経過時間の秒が次に変わるまで、それ以外は終了の確認のため 0.5 秒まで通知を待つ
+            timeout = 0.5
+            if status.get('state') == 'play' and 'elapsed' in status:
+                elapsed = float(status['elapsed']) + time.monotonic() - received
+                timeout = min(timeout, math.floor(elapsed) + 1 - elapsed)
+            self.__received.acquire()
             try:
-                s.update(self.__client.status())
-                modified = self.__status.copy(s)
-                if modified:
-                    self.__queue.put(modified)
-                # if self.__volume is None:
-                #     self.__volume = self.__status.volume
-            except:
-                pass
+                if self.__latest is None:
+                    self.__received.wait(timeout)
+                if self.__latest is not None:
+                    status, received = self.__latest
+                    self.__latest = None
             finally:
-                self.__lock.release()
+                self.__received.release()
+
+            # 前回の status からの経過時間を加えて、現在の経過時間とする
+            if status.get('state') == 'play' and 'elapsed' in status:
+                s.update(dict(status, elapsed=float(status['elapsed']) + time.monotonic() - received))
+            else:
+                s.update(status)
+            modified = self.__status.copy(s)
+            # 接続の状態が変わったときは 'connected' で知らせる
+            if self.connected != self.__connected:
+                self.__connected = self.connected
+                modified['connected'] = self.__connected
+            if modified:
+                self.__snapshot = StatusSnapshot(self.__status, self.__connected, self.__snapshot.sequence + 1)
+                self.__queue.put(modified)
+                if self.__notify:
+                    self.__notify()
+            # if self.__volume is None:
+            #     self.__volume = self.__status.volume
 
     def get_modified(self):
         return self.__queue.get() if not self.__queue.empty() else None
 
-    def set_album(self, album):
-        playlist = album.get_playlist()
-        self.__lock.acquire()
+    def set_notify(self, callback):
+        # get_modified で取り出せる変化が増えたときに、Player のスレッドから callback() を呼ぶ
+        self.__notify = callback
+
+    def execute(self, func):
+        # コマンド用の接続で func(client) をすぐに実行する。失敗した場合は None を返す
+        try:
+            return self.__command.execute(func)
+        except (MPDError, OSError) as e:
+            print('Player: {}'.format(e))
+            return None
+
+    def execute_commands(self):
+        # キューに溜まっているコマンドをまとめて1つの command_list で送る
+        terminated = False
+        while not terminated:
+            commands = [self.__commands.get()]
+            while not self.__commands.empty():
+                commands.append(self.__commands.get())
+            terminated = None in commands
+            commands = [c for c in commands if c]
+            if commands:
+                self.send_commands(commands)
+
+    def send_commands(self, commands):
         try:
-            self.__client.command_list_ok_begin()
-            self.__client.stop()
-            self.__client.clear()
-            # self.__client.add('muon.mp3')
-            # self.__client.add('{}/muon.mp3'.format(Artist.ROOT_PATH))
-            for url in playlist:
-                print(url)
-                self.__client.add(url)
-            self.__client.command_list_end()
-        except:
-            pass
-        finally:
-            self.__lock.release()
+            # 現在の状態によって送るコマンドが変わる場合は、先に status を取得する
+            status = None
+            files = None
+            if PlayerCommand.needs_status(commands):
+                status = self.__command.execute(lambda client: client.status())
+                if any(c.name == 'set_album' for c in commands):
+                    files = self.get_queue(status)
+            requests = PlayerCommand.coalesce(commands, status, files)
+            for n in range(0, len(requests), self.BATCH_SIZE):
+                batch = requests[n:n+self.BATCH_SIZE]
+                def send(client):
+                    client.command_list_ok_begin()
+                    for name, args in batch:
+                        getattr(client, name)(*args)
+                    return client.command_list_end()
+                self.__command.execute(send)
+        except (MPDError, OSError) as e:
+            print('Player: {}'.format(e))
+            for command in commands:
+                command.future.set_exception(e)
+            return
+        except Exception as e:
+            # 想定外の例外でもコマンドのスレッドは止めず、呼び出し側を待たせたままにしない
+            print('Player: unexpected error {}: {}'.format(type(e).__name__, e))
+            for command in commands:
+                command.future.set_exception(e)
+            return
+        for command in commands:
+            command.future.set_result(None)
+
+    def get_queue(self, status):
+        # MPD のプレイリストのファイル名のリストを返す
+        # 前回取得したときからバージョンが変わっていれば、変わった部分だけを plchanges で取得する
+        version = int(status.get('playlist') or 0)
+        length = int(status.get('playlistlength') or 0)
+        if self.__queue_version is None:
+            files = [song['file'] for song in self.__command.execute(lambda client: client.playlistinfo())]
+        elif self.__queue_version != version:
+            files = self.__queue_files[:length]
+            files += [None] * (length - len(files))
+            since = self.__queue_version
+            for song in self.__command.execute(lambda client: client.plchanges(since)):
+                files[int(song['pos'])] = song['file']
+        else:
+            files = self.__queue_files
+        self.__queue_version = version
+        self.__queue_files = files
+        return files
+
+    def post(self, name, *args):
+        command = PlayerCommand(name, *args)
+        self.__commands.put(command)
+        return command.future
+
+    def set_album(self, album):
+        return self.post('set_album', album.get_playlist())
 
     def play(self, song):   # song はゼロが１曲目
-        self.__lock.acquire()
-        try:
-            self.__client.play(song)
-        except:
-            pass
-        finally:
-            self.__lock.release()
+        return self.post('play', song)
 
     def toggle_pause(self):
-        self.__lock.acquire()
-        try:
-            if self.__status.state == PlaybackState.PAUSE:
-                self.__client.play()
-            elif self.__status.state == PlaybackState.PLAY:
-                self.__client.pause()
-        except:
-            pass
-        finally:
-            self.__lock.release()
+        return self.post('toggle_pause')
 
     def next(self):
-        self.__lock.acquire()
-        try:
-            self.__client.next()
-        except:
-            pass
-        finally:
-            self.__lock.release()
+        return self.post('next')
     
     def previous(self):
-        self.__lock.acquire()
-        try:
-            self.__client.previous()
-        except:
-            pass
-        finally:
-            self.__lock.release()
+        return self.post('previous')
 
     def stop(self):
-        self.__lock.acquire()
-        try:
-            self.__client.stop()
-        except:
-            pass
-        finally:
-            self.__lock.release()
+        return self.post('stop')
 
     # def set_volume(self, vol):
-    #     self.__lock.acquire()
-    #     try:
-    #         self.__client.setvol(vol)
-    #     except:
-    #         pass
-    #     finally:
-    #         self.__lock.release()
+    #     return self.post('setvol', vol)
 
     # def set_volume_delta(self, delta):
     #     if (delta in [-1, 1]) and (not self.__volume is None):
@@ -432,41 +949,31 @@ class Player:
     #         self.set_volume(self.__volume)
 
     def update_db(self):
-        self.stop()
+        # 呼び出したスレッドは待たせずに戻り、stop が終わったら (失敗した場合も) 別のスレッドでデータベースを更新する
+        # 戻り値の Future は、更新が終わると True (update を送れなかった場合は False) になる
+        done = Future()
+        def start(stopped):
+            # stop の完了はコマンドのスレッドから通知されるので、更新の完了を待つのは別のスレッドで行う
+            threading.Thread(target=self.wait_update_db, args=(stopped, done), daemon=True).start()
+        self.stop().add_done_callback(start)
+        return done
+
+    def wait_update_db(self, stopped, done):
+        if stopped.exception():
+            print('Player: stop failed ({})'.format(stopped.exception()))
         print('start update')
-        self.__lock.acquire()
-        try:
-            self.__client.update()
-        except:
+        if self.execute(lambda client: client.update()) is None:
             print('update failed')
-            pass
-        finally:
-            self.__lock.release()
-        print('waiting for beginning to update ...')
-        while True:
-            self.__lock.acquire()
-            try:
-                s = self.__client.status()
-            except:
-                pass
-            finally:
-                self.__lock.release()
-            if 'updateing_db' in s:
-                break
-            time.sleep(0.1)
+            done.set_result(False)
+            return
         print('updating database ...')
         while True:
-            self.__lock.acquire()
-            try:
-                s = self.__client.status()
-            except:
-                pass
-            finally:
-                self.__lock.release()
-            if 'updateing_db' not in s:
+            s = self.execute(lambda client: client.status()) or {}
+            if 'updating_db' not in s:
                 break
             time.sleep(0.1)
         print('done.')
+        done.set_result(True)
 
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
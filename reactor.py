@@ -0,0 +1,68 @@
+import os
+import selectors
+import threading
+
+
+# ------------------------------------------------------------------------------
+class Reactor:
+    # メインループが待ち受けるものを1つの selector にまとめる
+    #   - add_reader で登録したファイル記述子 (タッチパネルの evdev など) が読めるようになったとき
+    #   - 別のスレッドが wakeup を呼んだとき (Player の状態の変化、LibraryWatcher の通知など)
+    #   - wait に渡したタイムアウト (タイマーの期限) になったとき
+    # のいずれかまで眠る。別のスレッドからの通知には eventfd (無ければ pipe) を使う
+    def __init__(self):
+        self.__selector = selectors.DefaultSelector()
+        if hasattr(os, 'eventfd'):
+            self.__wakeup_r = self.__wakeup_w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.__wakeup_r, self.__wakeup_w = os.pipe()
+            os.set_blocking(self.__wakeup_r, False)
+            os.set_blocking(self.__wakeup_w, False)
+        self.__selector.register(self.__wakeup_r, selectors.EVENT_READ, None)
+        self.__wakeups = 0
+        self.__lock = threading.Lock()  # close した記述子に (番号が再利用されていれば別のファイルに) 書かないため
+        self.__closed = False
+
+    @property
+    def wakeups(self):
+        # wait から戻った回数 (アイドル時にどれだけ起こされているかの確認用)
+        return self.__wakeups
+
+    def add_reader(self, fd, callback):
+        self.__selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd):
+        self.__selector.unregister(fd)
+
+    def wakeup(self):
+        # どのスレッドから呼んでもよい。close した後は何もしない
+        with self.__lock:
+            if self.__closed:
+                return
+            try:
+                os.write(self.__wakeup_w, (1).to_bytes(8, 'little'))
+            except BlockingIOError:
+                # 既に通知が溜まっていれば、それで起こされる
+                pass
+
+    def wait(self, timeout=None):
+        # 何かが起こるか timeout 秒 (None なら無期限) 経つまで待ち、読めるようになったものの callback を呼ぶ
+        events = self.__selector.select(None if timeout is None else max(0, timeout))
+        self.__wakeups += 1
+        for key, mask in events:
+            if key.data is None:
+                try:
+                    os.read(self.__wakeup_r, 64)
+                except BlockingIOError:
+                    pass
+            else:
+                key.data()
+        return len(events)
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            self.__selector.close()
+            os.close(self.__wakeup_r)
+            if self.__wakeup_w != self.__wakeup_r:
+                os.close(self.__wakeup_w)
@@ -0,0 +1,103 @@
+import os
+import pickle
+from PIL import Image
+from catalog import Catalog
+
+
+# ------------------------------------------------------------------------------
+# 読み込み済みのカタログと、表示に使った縮小画像を SD カード上に保存しておき、
+# 次回の起動時に USB メモリ上のデータベースを解析せずに復元する
+# ------------------------------------------------------------------------------
+class Snapshot:
+    PATH = '/home/pi/player/cache/catalog.snapshot'
+    VERSION = 3
+
+    def __init__(self, path=PATH):
+        self.__path = path
+        self.__key = None           # 読み込んだときのデータベースファイルのキー
+        self.__catalog = None       # そのときに読み込んだカタログ (save で書き出す)
+
+    @property
+    def path(self):
+        return self.__path
+
+    @staticmethod
+    def get_key(database_path):
+        # データベースファイルのパス・サイズ・更新時刻が一致すればスナップショットは有効
+        # (起動のたびにデータベース全体を読まないよう、内容は比べない)
+        st = os.stat(database_path)
+        return {'path': os.path.abspath(database_path), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    @staticmethod
+    def get_mtime(source):
+        try:
+            return os.stat(source).st_mtime_ns
+        except OSError:
+            return None
+
+    def set_catalog(self, database_path, catalog):
+        # データベースから読み込んだカタログを覚えておく (終了時にデータベースを読み直さずに保存するため)
+        self.__key = Snapshot.get_key(database_path)
+        self.__catalog = catalog
+
+    def restore(self, database_path, image_cache=None):
+        # 有効なスナップショットがあればカタログを返す (無効な場合は None)
+        try:
+            with open(self.__path, mode='rb') as fp:
+                data = fp.read()
+            snapshot = pickle.loads(data)
+            if snapshot.get('version') != Snapshot.VERSION:
+                return None
+            key = Snapshot.get_key(database_path)
+            if snapshot['database'] == key:
+                catalog = Catalog.from_bytes(snapshot['catalog'])
+            elif (snapshot['database']['path'], snapshot['database']['size']) == (key['path'], key['size']):
+                # 更新時刻だけが変わっている場合 (コピーし直した場合など) は、内容が同じかを確かめる
+                # (データベースの解析は必要になるが、縮小画像のデコードは省略できる)
+                catalog = Catalog.load(database_path)
+                if catalog.to_bytes() != snapshot['catalog']:
+                    print('[Snapshot] {} has been modified'.format(database_path))
+                    return None
+            else:
+                print('[Snapshot] {} has been modified'.format(database_path))
+                return None
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError, EOFError) as e:
+            print('[Snapshot] unable to restore ({})'.format(e))
+            return None
+
+        restored = 0
+        if image_cache is not None:
+            for key, mtime, (mode, size, pixels) in snapshot['images']:
+                # 元画像が更新されていれば (カバーアートを差し替えて updator を実行し直した場合など)、
+                # 縮小画像は古いので復元しない (artwork.Thumbnail と同じく元画像の更新時刻で判断する)
+                if Snapshot.get_mtime(key[0]) != mtime:
+                    continue
+                image_cache.put(key, Image.frombytes(mode, size, pixels))
+                restored += 1
+        self.set_catalog(database_path, catalog)
+        print('[Snapshot] restored {} artists, {} images'.format(catalog.num_artists, restored))
+        return catalog
+
+    def save(self, database_path, image_cache=None):
+        # 縮小画像 (キーが (元画像, サイズ) のもの) だけを、元画像の更新時刻とともに保存する
+        # カタログは起動時に読み込んだもの (set_catalog/restore) を使い、キーもそのときのものにする
+        # (実行中にデータベースが更新されていれば、次回の起動時に無効になる)
+        images = []
+        if image_cache is not None:
+            for key, image in image_cache.items():
+                mtime = Snapshot.get_mtime(key[0]) if isinstance(key, tuple) else None
+                if mtime is not None:
+                    images.append((key, mtime, (image.mode, image.size, image.tobytes())))
+        if self.__catalog is None or self.__key['path'] != os.path.abspath(database_path):
+            self.set_catalog(database_path, Catalog.load(database_path))
+        snapshot = {
+            'version': Snapshot.VERSION,
+            'database': self.__key,
+            'catalog': self.__catalog.to_bytes(),
+            'images': images
+        }
+        os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+        temp_path = self.__path + '.tmp'
+        with open(temp_path, mode='wb') as fp:
+            pickle.dump(snapshot, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.__path)
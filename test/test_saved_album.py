@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from player  import ArtistList
+from catalog import Catalog
+
+
+def make_album(album_id, title, year, directory):
+    track = {'filename': '01.mp3', 'index': 1, 'duration': 180, 'artist': 'Artist', 'album': title, 'title': 'Track', 'year': year}
+    return {'id': album_id, 'title': title, 'year': year, 'directory': directory, 'totalTime': 180, 'tracks': [track]}
+
+# updator が作成したデータベース (アーティスト 100, 200 がそれぞれアルバムを 2 枚ずつ持つ)
+DATABASE = [
+    {'id': 100, 'name': 'Artist A', 'directory': 'artista',
+     'albums': [make_album(101, 'A1', 2001, 'a1'), make_album(102, 'A2', 2002, 'a2')]},
+    {'id': 200, 'name': 'Artist B', 'directory': 'artistb',
+     'albums': [make_album(201, 'B1', 2001, 'b1'), make_album(202, 'B2', 2002, 'b2')]},
+]
+
+# ------------------------------------------------------------------------------
+class SavedAlbumTest(unittest.TestCase):
+    def boot(self, config):
+        # Application の起動時と同じく、前回のアーティストを先に読み込んでから保存したアルバムを探す
+        artist_list = ArtistList()
+        artist_list.load_catalog(Catalog.from_json(DATABASE), config['artist'])
+        album = artist_list.find_saved_album(config['artist'], config['album'])
+        artist_list.wait()
+        return album
+
+    def test_saved_album(self):
+        album = self.boot({'artist': 200, 'album': 202})
+        self.assertEqual(album.album_id, 202)
+
+    def test_live_added_album(self):
+        # 実行中に LibraryWatcher が追加したアルバムを演奏したまま終了した
+        artist_list = ArtistList()
+        artist_list.load_catalog(Catalog.from_json(DATABASE))
+        artist_list.apply_delta({'type': 'album',
+                                 'artist': {'id': 200, 'name': 'Artist B', 'directory': 'artistb'},
+                                 'album': make_album(203, 'B3', 2003, 'b3')})
+        album = artist_list.find_saved_album(200, 203)
+        config = {'artist': album.artist.artist_id, 'album': album.album_id}
+        self.assertEqual(config, {'artist': 200, 'album': 203})
+
+        # 次の起動では 203 はデータベースに無いので、同じアーティストの先頭のアルバムになる
+        album = self.boot(config)
+        self.assertEqual((album.artist.artist_id, album.album_id), (200, 201))
+
+    def test_live_added_artist(self):
+        # 実行中に追加されたアーティストも無ければ、先頭のアーティストの先頭のアルバムになる
+        album = self.boot({'artist': 300, 'album': 301})
+        self.assertEqual((album.artist.artist_id, album.album_id), (100, 101))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,9 @@ import time
 import threading
 import queue
 import json
-from select import select
+import re
+import weakref
+from collections import OrderedDict
 from PIL import Image
 from evdev import (InputDevice, ecodes)
 from enum import Enum, Flag, auto
@@ -20,6 +22,336 @@ class TextAlign(Flag):
     MIDDLE  = auto()
     BOTTOM  = auto()
 
+# ------------------------------------------------------------------------------
+class SurfaceCache:
+    # 画像 (PIL) を変換した surface を LRU で保持する
+    # 画像そのものは弱参照で持つだけなので、ImageCache から追い出された画像を生かし続けることはなく
+    # (その surface も次の get で捨てる)、budget は surface の分だけを数えればよい
+    DEFAULT_BUDGET = 8 * 1024 * 1024
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.__budget = budget
+        self.__surfaces = OrderedDict()     # (id(画像), サイズ) -> (画像への弱参照, surface, 使用バイト数)
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__dead = []                    # 解放された画像の id (解放したスレッドから追加される)
+
+    @property
+    def budget(self):
+        return self.__budget
+    @budget.setter
+    def budget(self, v):
+        self.__budget = v
+        self.__evict()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    def get(self, buffer, size):
+        # PIL の画像を、表示用フォーマットに変換・拡大縮小済みの surface として返す
+        # 弱参照で同じ画像であることを確かめるので、id() が別の画像に再利用されても取り違えない
+        self.__purge()
+        key = (id(buffer), tuple(size))
+        entry = self.__surfaces.get(key)
+        if entry and entry[0]() is buffer:
+            self.__surfaces.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+        self.__misses += 1
+        surface = pygame.image.fromstring(buffer.tobytes(), buffer.size, buffer.mode).convert()
+        if surface.get_size() != key[1]:
+            # 縮小済みの画像(サムネイル)であれば拡大縮小は不要
+            surface = pygame.transform.scale(surface, key[1])
+        nbytes = surface.get_width() * surface.get_height() * surface.get_bytesize()
+        if entry:
+            self.__size -= entry[2]
+        self.__surfaces[key] = (weakref.ref(buffer, lambda ref, i=id(buffer): self.__dead.append(i)), surface, nbytes)
+        self.__size += nbytes
+        self.__evict()
+        return surface
+
+    def clear(self):
+        self.__surfaces.clear()
+        self.__size = 0
+
+    def __purge(self):
+        # 解放された画像の surface を捨てる (弱参照のコールバックは別のスレッドで呼ばれることがあるので、ここで行う)
+        while self.__dead:
+            i = self.__dead.pop()
+            for key in [k for k in self.__surfaces if k[0] == i]:
+                if self.__surfaces[key][0]() is None:
+                    self.__size -= self.__surfaces.pop(key)[2]
+
+    def __evict(self):
+        while self.__size > self.__budget and len(self.__surfaces) > 1:
+            key, (ref, surface, nbytes) = self.__surfaces.popitem(last=False)
+            self.__size -= nbytes
+
+# ------------------------------------------------------------------------------
+class TextCache:
+    # font.render で描画した文字列の surface を、LRU でメモリの上限 (budget バイト) まで保持する
+    # 'track' や 'time' などの見出し・アイコン・7セグの数字は同じものを何度も描画するので、
+    # 2回目からは FreeType でのラスタライズを省いて blit だけで済ませる
+    DEFAULT_BUDGET = 2 * 1024 * 1024
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.__budget = budget
+        self.__surfaces = OrderedDict()     # (フォント, 文字列, 文字色, 背景色, antialias) -> (フォント, surface, 使用バイト数)
+        self.__size = 0
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def budget(self):
+        return self.__budget
+    @budget.setter
+    def budget(self, v):
+        self.__budget = v
+        self.__evict()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    def render(self, font_key, text, fgcol, bkcol=None, antialias=True):
+        # font_key は Canvas.fonts のキー。返した surface は共有されるので、変更してはいけない
+        font = Canvas.fonts[font_key]
+        key = (font_key, text, tuple(fgcol), tuple(bkcol) if bkcol else None, antialias)
+        entry = self.__surfaces.get(key)
+        if entry and entry[0] is font:
+            self.__surfaces.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+        self.__misses += 1
+        surface = font.render(text, antialias, fgcol, bkcol)
+        nbytes = surface.get_width() * surface.get_height() * surface.get_bytesize()
+        if entry:
+            self.__size -= entry[2]
+        self.__surfaces[key] = (font, surface, nbytes)
+        self.__size += nbytes
+        self.__evict()
+        return surface
+
+    def clear(self):
+        self.__surfaces.clear()
+        self.__size = 0
+
+    def __evict(self):
+        while self.__size > self.__budget and len(self.__surfaces) > 1:
+            key, (font, surface, nbytes) = self.__surfaces.popitem(last=False)
+            self.__size -= nbytes
+
+# ------------------------------------------------------------------------------
+class TextLayout:
+    # draw_text_rect_wrap の折り返しの結果 (行のリスト) を (フォント, 文字列, 幅, 行数) ごとに LRU で保持する
+    #   - 単語の幅はレイアウトごとに1回だけ測り、行の幅は足し算で求める (幅に近づいたら行全体を測り直す)
+    #   - 空白の無い日本語・中国語は1文字ずつ折り返せる (句読点などは行頭に来ないようにする)
+    #   - 1語で幅を超える場合は文字単位で折り返し、行数に収まらない場合は最後の行を '…' で省略する
+    MAX_ENTRIES = 1024
+    ELLIPSIS = '\u2026'
+    KERNING_SLACK = 4       # 単語の幅の合計がこれ (px) 以上幅に近づいたら、行全体を測り直す
+    # 折り返しの単位: 空白 / CJK の1文字 / それ以外の連続した文字 (英単語など)
+    TOKEN = re.compile(r'\s+|[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]|[^\s\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+')
+    # 行頭に置かない文字 (前の行に付ける)
+    NO_BREAK_BEFORE = set('、。，．,.・：；:;！？!?）)」』】〕ーぁぃぅぇぉっゃゅょゎァィゥェォッャュョヮヵヶ々〜')
+
+    def __init__(self):
+        self.__layouts = OrderedDict()      # (フォント, 文字列, 幅, 行数) -> (フォント, 行のタプル)
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    def wrap(self, font_key, text, width, max_lines=None):
+        # text を幅 width に収まるように折り返した行のタプルを返す
+        font = Canvas.fonts[font_key]
+        key = (font_key, text, width, max_lines)
+        entry = self.__layouts.get(key)
+        if entry and entry[0] is font:
+            self.__layouts.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+        self.__misses += 1
+        lines = self.__layout(font, text, width)
+        if max_lines is not None and len(lines) > max(1, max_lines):
+            max_lines = max(1, max_lines)
+            lines = lines[:max_lines - 1] + [self.__ellipsize(font, lines[max_lines - 1], width)]
+        lines = tuple(lines)
+        self.__layouts[key] = (font, lines)
+        while len(self.__layouts) > self.MAX_ENTRIES:
+            self.__layouts.popitem(last=False)
+        return lines
+
+    def clear(self):
+        self.__layouts.clear()
+
+    def __layout(self, font, text, width):
+        space = font.size(' ')[0]
+        lines = []
+        line, line_width = [], 0
+        pending_space = False           # 直前の単語の後に空白があった
+        for token in self.TOKEN.findall(text):
+            if token.isspace():
+                pending_space = bool(line)
+                continue
+            w = font.size(token)[0]
+            gap = space if pending_space else 0
+            pending_space = False
+            if line and line_width + gap + w > width - self.KERNING_SLACK:
+                # 単語の幅の合計はカーニングを含まないので、幅に近づいたら行全体の実際の幅で確かめる
+                actual = font.size(''.join(line) + (' ' if gap else '') + token)[0]
+                if actual <= width:
+                    if gap:
+                        line.append(' ')
+                    line.append(token)
+                    line_width = actual
+                    continue
+                carried = []
+                if token[0] in self.NO_BREAK_BEFORE and len(line) > 1:
+                    # 行頭に置けない文字は、直前の単語と一緒に次の行に送る
+                    carried = [line.pop()]
+                    if line[-1] == ' ':
+                        line.pop()
+                lines.append(''.join(line))
+                line = carried
+                line_width = font.size(carried[0])[0] if carried else 0
+                gap = gap if carried else 0
+            if not line and w > width:
+                # 1語で幅を超える場合は文字単位で分ける
+                parts = self.__split_word(font, token, width)
+                lines += parts[:-1]
+                token = parts[-1]
+                w = font.size(token)[0]
+            if gap:
+                line.append(' ')
+            line.append(token)
+            line_width += gap + w
+        if line:
+            lines.append(''.join(line))
+        return lines
+
+    @staticmethod
+    def __split_word(font, word, width):
+        parts = []
+        start = 0
+        for end in range(1, len(word) + 1):
+            if end - start > 1 and font.size(word[start:end])[0] > width:
+                parts.append(word[start:end - 1])
+                start = end - 1
+        parts.append(word[start:])
+        return parts
+
+    def __ellipsize(self, font, line, width):
+        # 後ろから文字を削り、'…' を付けて幅に収める (切り詰める位置は二分探索で探す)
+        lo, hi = 0, len(line)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if font.size(line[:mid].rstrip() + self.ELLIPSIS)[0] <= width:
+                lo = mid
+            else:
+                hi = mid - 1
+        return line[:lo].rstrip() + self.ELLIPSIS
+
+# ------------------------------------------------------------------------------
+class DirtyRegion:
+    # 画面のうち更新が必要な領域を、複数の矩形のリストとして保持する
+    # 重なる・隣接する矩形は、まとめた方が転送する画素数 (+ 矩形ごとのオーバーヘッド) が
+    # 少なくなる場合にだけ1つにまとめる (画面の上下が同時に変わっても、その間は転送しない)
+    RECT_COST = 4096        # 矩形を1つ増やすことのコスト (画素数に換算)
+    MAX_RECTS = 8
+
+    def __init__(self):
+        self.__rects = []
+        self.__frames = 0
+        self.__pixels = 0           # これまでに転送した画素数
+        self.__last_pixels = 0      # 直前のフレームで転送した画素数
+        self.__saved = 0            # 全体を囲む矩形1つで転送した場合と比べて減らせた画素数
+
+    @property
+    def rects(self):
+        return list(self.__rects)
+
+    @property
+    def frames(self):
+        return self.__frames
+
+    @property
+    def pixels(self):
+        return self.__pixels
+
+    @property
+    def last_pixels(self):
+        return self.__last_pixels
+
+    @property
+    def saved(self):
+        return self.__saved
+
+    def add(self, rect):
+        rect = Rect(rect).clip(Canvas.screen.get_rect()) if Canvas.screen else Rect(rect)
+        if rect.width <= 0 or rect.height <= 0:
+            return
+        while True:
+            for i, r in enumerate(self.__rects):
+                if r.contains(rect):
+                    return
+                if self.__merge_cost(r, rect) <= self.RECT_COST:
+                    # まとめた矩形で、他の矩形ともう一度比べる
+                    rect = self.__rects.pop(i).union(rect)
+                    break
+            else:
+                break
+        if len(self.__rects) >= self.MAX_RECTS:
+            # 増えすぎたら、まとめて増える画素数が最も少ない矩形とまとめる
+            i = min(range(len(self.__rects)), key=lambda i: self.__merge_cost(self.__rects[i], rect))
+            rect = self.__rects.pop(i).union(rect)
+        self.__rects.append(rect)
+
+    def take(self):
+        # 溜まっている矩形を返して空にする
+        rects, self.__rects = self.__rects, []
+        pixels = sum(r.width * r.height for r in rects)
+        if rects:
+            bounds = rects[0].unionall(rects[1:])
+            self.__saved += bounds.width * bounds.height - pixels
+            self.__frames += 1
+        self.__pixels += pixels
+        self.__last_pixels = pixels
+        return rects
+
+    def clear(self):
+        self.__rects = []
+
+    @staticmethod
+    def __merge_cost(a, b):
+        # まとめることで余分に転送する画素数
+        u = a.union(b)
+        return u.width * u.height - a.width * a.height - b.width * b.height
+
 # ------------------------------------------------------------------------------
 class Canvas:
     SCREEN_WIDTH  = 1024
@@ -29,6 +361,7 @@ class Canvas:
     SSEG_PATH = '/home/pi/player/res/LED7SEG_Standard.ttf'
     # ICON_PATH = './res/MaterialIcons-Regular.ttf'
     ICON_PATH = '/home/pi/player/res/Material-Design-Iconic-Font.ttf'
+    CODEPOINTS_PATH = '/home/pi/player/res/codepoints.json'
 
     BLACK      = (0x00, 0x00, 0x00)
     DARKGRAY   = (0x33, 0x33, 0x33)
@@ -46,7 +379,10 @@ class Canvas:
     screen = None
     fonts = {}
     icon_code = {}
-    dirty_rect = Rect(0, 0, 0, 0)
+    dirty_region = DirtyRegion()
+    surface_cache = SurfaceCache()
+    text_cache = TextCache()
+    text_layout = TextLayout()
 
     # --------------------------------------------------------------------------
     @classmethod
@@ -55,14 +391,16 @@ class Canvas:
         pygame.init()
         pygame.mouse.set_visible(False)
         Canvas.screen = pygame.display.set_mode((Canvas.SCREEN_WIDTH, Canvas.SCREEN_HEIGHT))
-        Canvas.dirty_rect = Rect(0, 0, 0, 0)
+        Canvas.dirty_region.clear()
+        Canvas.text_cache.clear()
+        Canvas.text_layout.clear()
         Canvas.fonts = {
             20:     pygame.font.Font(Canvas.FONT_PATH, 20),
             'sseg': pygame.font.Font(Canvas.SSEG_PATH, 50),     # 55 -> '00' の幅=86, 高さ=60
             'icon_small': pygame.font.Font(Canvas.ICON_PATH, 30),
             'icon_large': pygame.font.Font(Canvas.ICON_PATH, 72)
         }
-        with open('/home/pi/player/res/codepoints.json', mode='r') as fp:
+        with open(Canvas.CODEPOINTS_PATH, mode='r') as fp:
             data = json.load(fp)
             for name, code in data.items():
                 Canvas.icon_code[name] = int(code, 16)
@@ -76,8 +414,9 @@ class Canvas:
     # --------------------------------------------------------------------------
     @classmethod
     def update(cls):
-        pygame.display.update(Canvas.dirty_rect)
-        Canvas.dirty_rect = Rect(0, 0, 0, 0)
+        rects = Canvas.dirty_region.take()
+        if rects:
+            pygame.display.update(rects)
 
     # --------------------------------------------------------------------------
     def __init__(self, rect):
@@ -87,11 +426,17 @@ class Canvas:
         self.__current_font_size = 16
 
     # --------------------------------------------------------------------------
-    def blit(self, pos):
-        Canvas.screen.blit(self.__surface, pos)
+    def blit(self, pos, area=None):
+        # area (画面の座標) を指定した場合は、その範囲に重なる部分だけを転送する
         r = self.__screen_rect.copy()
         r.topleft = pos
-        Canvas.dirty_rect.union_ip(r)
+        if area is not None:
+            r = r.clip(area)
+            if r.width <= 0 or r.height <= 0:
+                return False
+        Canvas.screen.blit(self.__surface, r.topleft, r.move(-pos[0], -pos[1]))
+        Canvas.dirty_region.add(r)
+        return True
 
     # --------------------------------------------------------------------------
     def set_font_size(self, size):
@@ -117,14 +462,11 @@ class Canvas:
         pygame.draw.circle(self.__surface, color, center, radius, width)
 
     def draw_text(self, pos, text, fgcol, bkcol=None):
-        font = Canvas.fonts[self.__current_font_size]
-        text_surface = font.render(text, True, fgcol, bkcol)
-        size = text_surface.get_size()
+        text_surface = Canvas.text_cache.render(self.__current_font_size, text, fgcol, bkcol)
         self.__surface.blit(text_surface, pos)
 
     def draw_text_rect(self, bound_rect, text, alignment, fgcol, bkcol=None):
-        font = Canvas.fonts[self.__current_font_size]
-        text_surface = font.render(text, True, fgcol, bkcol)
+        text_surface = Canvas.text_cache.render(self.__current_font_size, text, fgcol, bkcol)
         text_rect = text_surface.get_rect()
         bound_rect = Rect(bound_rect)
         if alignment & TextAlign.CENTER:
@@ -155,27 +497,12 @@ class Canvas:
         self.__surface.set_clip(None)
 
     def draw_text_rect_wrap(self, bound_rect, text, alignment, fgcol, bkcol=None):
+        # 折り返した結果は Canvas.text_layout に、各行の surface は Canvas.text_cache にキャッシュされる
+        # bound_rect の高さに収まらない行は、最後の行を '…' で省略する
         font = Canvas.fonts[self.__current_font_size]
         bound_rect = Rect(bound_rect)
-        # print('width = {}'.format(bound_rect.width))
-        words = text.split(' ')
-        line = '' #words.pop(0)
-        text_surfaces = []
-        while len(words) > 0:
-            w = font.size(line + ' ' + words[0])[0]
-            # print('line : {} (width = {})'.format(line + ' ' + words[0], w))
-            if w <= bound_rect.width:
-                if line:
-                    line += ' '
-                line += words.pop(0)
-            else:
-                # print('-- newline')
-                text_surfaces.append(font.render(line, True, fgcol, bkcol))
-                line = ''
-        if line:
-            # print('line : {}'.format(line))
-            # print('-- newline (end)')
-            text_surfaces.append(font.render(line, True, fgcol, bkcol))
+        line_height = font.get_height()
+        lines = Canvas.text_layout.wrap(self.__current_font_size, text, bound_rect.width, bound_rect.height // line_height)
 
         x = bound_rect.right if (alignment & TextAlign.RIGHT) else bound_rect.left
         y = bound_rect.top
@@ -184,32 +511,28 @@ class Canvas:
         if bkcol:
             self.fill_rect(bound_rect, bkcol)
 
-        for surface in text_surfaces:
+        for line in lines:
+            surface = Canvas.text_cache.render(self.__current_font_size, line, fgcol, bkcol)
             text_rect = surface.get_rect()
             if alignment & TextAlign.RIGHT:
                 text_rect.topright = (x, y)
             else:
                 text_rect.topleft = (x, y)
             self.__surface.blit(surface, text_rect)
-            y += text_rect.height
-    
+            y += line_height
+
         self.__surface.set_clip(None)
 
     def draw_sseg(self, pos, text, fgcol, bkcol=None):
-        font = Canvas.fonts['sseg']
-        surface = font.render(text, True, fgcol, bkcol)
-        size = surface.get_size()
+        surface = Canvas.text_cache.render('sseg', text, fgcol, bkcol)
         self.__surface.blit(surface, pos)
 
     def draw_icon(self, ls, pos, name, fgcol, bkcol=None):
-        font = Canvas.fonts['icon_{}'.format(ls)]
-        surface = font.render(chr(Canvas.icon_code[name]), True, fgcol, bkcol)
-        size = surface.get_size()
+        surface = Canvas.text_cache.render('icon_{}'.format(ls), chr(Canvas.icon_code[name]), fgcol, bkcol)
         self.__surface.blit(surface, pos)
 
     def draw_icon_center(self, ls, pos, name, fgcol, bkcol=None):
-        font = Canvas.fonts['icon_{}'.format(ls)]
-        surface = font.render(chr(Canvas.icon_code[name]), True, fgcol, bkcol)
+        surface = Canvas.text_cache.render('icon_{}'.format(ls), chr(Canvas.icon_code[name]), fgcol, bkcol)
         rect = surface.get_rect()
         rect.center = pos
         self.__surface.blit(surface, rect)
@@ -218,29 +541,28 @@ class Canvas:
         # path が指す画像は PNG を想定している。
         # PNG 画像は直接 pygame.image.load で読み込めないので、Pillow を使う
         # buffer = Image.open(path).convert('RGB')
-        image = pygame.image.fromstring(buffer.tobytes(), buffer.size, buffer.mode).convert()
-        image = pygame.transform.scale(image, Rect(rect).size)
+        # 変換済みの surface はキャッシュしておき、同じ画像の再描画は blit だけで済ませる
+        image = Canvas.surface_cache.get(buffer, Rect(rect).size)
         self.__surface.blit(image, rect)
 
 # ------------------------------------------------------------------------------
 class TouchManager:
+    # タッチパネルの入力は、メインループ (Reactor) が fileno() を待ち受け、読めるようになったら read_device を呼ぶ
     def __init__(self):
         self.__device = InputDevice('/dev/input/event1')
         self.__touched = False
         self.__listeners = []
         self.__pos = {}
         self.__queue = queue.Queue()
-        self.__terminated = False
-        self.__thread = threading.Thread(target=self.execute)
-        self.__thread.start()
 
     def quit(self):
         print('[TouchManager] terminating...')
-        self.__terminated = True
-        self.__thread.join()
         # os.close(self.__device.fd)
         print('[TouchManager] successfully terminated')
 
+    def fileno(self):
+        return self.__device.fd
+
     def add_event_listener(self, listener):
         if not [w for w in self.__listeners if w.id == listener.id]:
             # NOTE: リストの先頭に追加される点に注意
@@ -270,60 +592,66 @@ class TouchManager:
         # screen_y = Canvas.SCREEN_HEIGHT - y
         # return (screen_x, screen_y)
 
-    def execute(self):
-        while not self.__terminated:
-            r, w, c = select([self.__device.fd], [], [], 0.1)
-            if self.__device.fd in r:
-                for event in self.__device.read():
-                    if event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
-                        if event.value:
-                            self.__touched = True
-                            self.__pos = {}
-                        else:
-                            print('released')
-                            self.__touched = False
-                            if ('x' in self.__pos) and ('y' in self.__pos):
-                                self.__queue.put({'touched': False, 'pos': self.get_screen_coord(), 'raw': self.__pos})
-                    if event.type == ecodes.EV_ABS:
-                        if event.code == ecodes.ABS_X:
-                            self.__pos['x'] = event.value 
-                        if event.code == ecodes.ABS_Y:
-                            self.__pos['y'] = event.value
-                        if self.__touched and ('x' in self.__pos) and ('y' in self.__pos):
-                            pos = self.get_screen_coord()
-                            print('touched ({}, {})'.format(pos[0], pos[1]))
-                            self.__queue.put({'touched': True, 'pos': pos, 'raw': self.__pos})
-                            self.__touched = False
+    def read_device(self):
+        # 溜まっている入力イベントを読み、タッチ・リリースをキューに積む
+        try:
+            events = list(self.__device.read())
+        except BlockingIOError:
+            return
+        for event in events:
+            if event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
+                if event.value:
+                    self.__touched = True
+                    self.__pos = {}
+                else:
+                    print('released')
+                    self.__touched = False
+                    if ('x' in self.__pos) and ('y' in self.__pos):
+                        self.__queue.put({'touched': False, 'pos': self.get_screen_coord(), 'raw': self.__pos})
+            if event.type == ecodes.EV_ABS:
+                if event.code == ecodes.ABS_X:
+                    self.__pos['x'] = event.value 
+                if event.code == ecodes.ABS_Y:
+                    self.__pos['y'] = event.value
+                if self.__touched and ('x' in self.__pos) and ('y' in self.__pos):
+                    pos = self.get_screen_coord()
+                    print('touched ({}, {})'.format(pos[0], pos[1]))
+                    self.__queue.put({'touched': True, 'pos': pos, 'raw': self.__pos})
+                    self.__touched = False
 
 # ------------------------------------------------------------------------------
 class TimerPool:
+    # 期限の確認はメインループが行う (next_timeout までは眠ってよい)
     def __init__(self):
         self.__users = []
-        self.__terminated = False
         self.__queue = queue.Queue()
         self.__lock = threading.Lock()
-        self.__thread = threading.Thread(target=self.execute)
-        self.__thread.start()
 
     def quit(self):
-        self.__terminated = True
-        self.__thread.join()
+        pass
 
     def get_expired(self):
+        self.__lock.acquire()
+        canceled = []
+        for user in self.__users:
+            if time.time() >= user['timeout']['start'] + user['timeout']['value']:
+                widget = user['widget']
+                print('timer expired ({})'.format(widget.id))
+                self.__queue.put(widget)
+                canceled.append(widget.id)
+        self.__users = [u for u in self.__users if u['widget'].id not in canceled]
+        self.__lock.release()
         return self.__queue.get() if not self.__queue.empty() else None
 
-    def execute(self):
-        while not self.__terminated:
-            time.sleep(0.1)
-            self.__lock.acquire()
-            canceled = []
-            for user in self.__users:
-                if time.time() >= user['timeout']['start'] + user['timeout']['value']:
-                    widget = user['widget']
-                    print('timer expired ({})'.format(widget.id))
-                    self.__queue.put(widget)
-                    canceled.append(widget.id)
-            self.__users = [u for u in self.__users if u['widget'].id not in canceled]
+    def next_timeout(self):
+        # 最も早く期限が来るタイマーまでの秒数。タイマーが無ければ None
+        self.__lock.acquire()
+        try:
+            if not self.__users:
+                return None
+            deadline = min(u['timeout']['start'] + u['timeout']['value'] for u in self.__users)
+            return max(0, deadline - time.time())
+        finally:
             self.__lock.release()
 
     def use(self, widget, timeout, idle=False):
@@ -353,9 +681,95 @@ class TimerPool:
             print('timer reset ({})'.format(user['widget'].id))
         self.__lock.release()
 
+# ------------------------------------------------------------------------------
+class FrameScheduler:
+    # refresh された widget を覚えておき、フレームごとにまとめて描画して、画面への転送を1回にする
+    # (スクロールで複数のパネルとボタンを refresh しても、/dev/fb1 への転送は1回になる)
+    # 描画し直すのは内容が変わった (dirty な) widget だけで、それ以外は保持している canvas を転送し直すだけにする
+    MAX_FPS = 30
+
+    def __init__(self):
+        self.__invalid = OrderedDict()  # id -> widget。末尾ほど最近 refresh されたもの
+        self.__damage = []              # (widget, 画面の矩形)。widget のうち、その範囲だけ転送し直す
+        self.__last_frame = 0
+        self.__requests = 0
+        self.__frames = 0
+        self.__draws = 0
+        self.__blits = 0
+
+    @property
+    def requests(self):
+        return self.__requests
+
+    @property
+    def frames(self):
+        return self.__frames
+
+    @property
+    def draws(self):
+        # widget の draw を呼んだ回数
+        return self.__draws
+
+    @property
+    def blits(self):
+        # canvas を画面のバッファに転送した回数
+        return self.__blits
+
+    def count(self, draws=0, blits=0):
+        self.__draws += draws
+        self.__blits += blits
+
+    def invalidate(self, widget):
+        # 最後に refresh された順に描画する (重なっている場合は、後から refresh したものが上になる)
+        self.__invalid[widget.id] = widget
+        self.__invalid.move_to_end(widget.id)
+        self.__requests += 1
+
+    def damage(self, widget, rect):
+        # widget の描画はそのままで、rect (画面の座標) の範囲だけを転送し直す (Popup を閉じたときなど)
+        self.__damage.append((widget, Rect(rect)))
+        self.__requests += 1
+
+    def cancel(self, widget):
+        self.__invalid.pop(widget.id, None)
+
+    def next_timeout(self):
+        # 次のフレームを描画できるまでの秒数。描画するものが無ければ None
+        if not self.__invalid and not self.__damage:
+            return None
+        return max(0, self.__last_frame + 1 / self.MAX_FPS - time.monotonic())
+
+    def flush(self, force=False):
+        # 描画の間隔が 1/MAX_FPS 秒を過ぎていれば、溜まっている widget を描画して画面を更新する
+        if not self.__invalid and not self.__damage:
+            return False
+        now = time.monotonic()
+        if not force and now < self.__last_frame + 1 / self.MAX_FPS:
+            return False
+        widgets = list(self.__invalid.values())
+        self.__invalid.clear()
+        damage, self.__damage = self.__damage, []
+        for widget, rect in damage:
+            if widget.is_visible():
+                widget.paint()
+                widget.render(rect)
+        ids = set(w.id for w in widgets)
+        for widget in widgets:
+            # 親も refresh されていれば、親の描画で子も描画される
+            if any(parent.id in ids for parent in widget.ancestors()):
+                continue
+            if widget.is_visible():
+                widget.paint()
+                widget.render()
+        Canvas.update()
+        self.__last_frame = now
+        self.__frames += 1
+        return True
+
 # ------------------------------------------------------------------------------
 class UIWidget:
     timer = TimerPool()
+    frames = FrameScheduler()
 
     def __init__(self, parent=None):
         self.__parent = parent
@@ -364,6 +778,7 @@ class UIWidget:
         self.__captured = False
         self.__children = []
         self.__canvas = None
+        self.__dirty = True         # canvas の内容を描画し直す必要がある
         self.__tag = None
         if self.__parent:
             self.__parent.add_child(self)
@@ -398,6 +813,14 @@ class UIWidget:
     def client_rect(self):
         return self.__client_rect
 
+    @property
+    def screen_rect(self):
+        return Rect(self.__screen_offset, self.__client_rect.size)
+
+    @property
+    def dirty(self):
+        return self.__dirty
+
     @property
     def captured(self):
         return self.__captured
@@ -462,24 +885,62 @@ class UIWidget:
         if etype in self.__events:
             self.__events[etype](param)
 
-    def render(self):
+    def ancestors(self):
+        parent = self.__parent
+        while parent:
+            yield parent
+            parent = parent.parent
+
+    def render(self, area=None):
+        # 画面のバッファに転送するだけで、実際の画面の更新は FrameScheduler.flush が行う
+        # area (画面の座標) を指定した場合は、それに重なる部分だけを転送する
         if not self.is_visible():
             return
-        self.__canvas.blit(self.__screen_offset)
+        if self.__canvas.blit(self.__screen_offset, area):
+            UIWidget.frames.count(blits=1)
         for child in self.__children:
-            child.render()
-        Canvas.update()
+            child.render(area)
+
+    def paint(self):
+        # dirty な widget だけを描画し直す。dirty でなければ canvas の内容をそのまま使い、子だけを調べる
+        # 非表示の widget は dirty のままにしておき、表示されたときに描画する
+        if not self.__visible:
+            return
+        if self.__dirty:
+            self.__dirty = False
+            UIWidget.frames.count(draws=1)
+            self.draw()
+        else:
+            for child in self.__children:
+                child.paint()
+
+    def invalidate(self):
+        # 自身と子孫の canvas の内容が変わったことにする (非表示の間も記録しておく)
+        self.__dirty = True
+        for child in self.__children:
+            child.invalidate()
 
     def refresh(self):
+        # 描画は次のフレームで行う
+        self.invalidate()
+        if not self.is_visible():
+            return
+        UIWidget.frames.invalidate(self)
+
+    def repaint(self, rect=None):
+        # 内容は変わっていないが、rect (画面の座標。省略時は自身の全体) の範囲を転送し直す
         if not self.is_visible():
             return
-        self.draw()
-        self.render()
+        UIWidget.frames.damage(self, rect if rect else self.screen_rect)
 
     def enable(self):
-        self.__enable = True
+        if not self.__enable:
+            self.__enable = True
+            self.__dirty = True
     def disable(self):
-        self.__enable = False
+        if self.__enable:
+            self.__enable = False
+            self.__dirty = True
     def is_enabled(self):
         if self.__enable:
             if not self.__parent or self.__parent.is_enabled():
@@ -487,10 +948,13 @@ class UIWidget:
         return False
 
     def show(self):
+        # 隠れている間に変わった (dirty な) widget だけを描画し、それ以外は転送し直すだけにする
         self.__visible = True
-        self.refresh()
+        if self.is_visible():
+            UIWidget.frames.invalidate(self)
     def hide(self):
         UIWidget.timer.cancel(self)
+        UIWidget.frames.cancel(self)
         self.__visible = False
     def is_visible(self):
         if self.__visible:
@@ -504,8 +968,7 @@ class UIWidget:
 
     def draw(self):
         for child in self.__children:
-            child.draw()
-        pass
+            child.paint()
 
     def set_timeout(self, timeout, idle=False):
         UIWidget.timer.use(self, timeout, idle)
@@ -677,10 +1140,15 @@ class Popup(UIWidget):
         super().show()
 
     def hide(self):
+        # Popup.__init__ からの hide は、まだ作成も表示もしていない
+        shown = self.is_visible() and self.canvas is not None
         super().hide()
         if Popup.touch and Popup.desktop:
             Popup.touch.remove_event_listener(self)
-            Popup.desktop.refresh()
+            # 下にある widget の内容は変わっていないので、表示していた Popup の範囲を転送し直すだけでよい
+            # (作成時などの表示していない Popup の hide では何もしない)
+            if shown:
+                Popup.desktop.repaint(self.screen_rect)
 
     def draw(self):
         super().draw()
@@ -702,13 +1170,21 @@ class Popup(UIWidget):
 
 
 if __name__ == '__main__':
+    from reactor import Reactor
+
     touch = TouchManager()
+    reactor = Reactor()
+    # タッチパネルが読めるようになるまで眠り、読み込んだイベントを表示する
+    reactor.add_reader(touch.fileno(), touch.read_device)
     while True:
         try:
+            reactor.wait()
             e = touch.peek_event()
-            if e:
+            while e:
                 print(e)
+                e = touch.peek_event()
 
         except KeyboardInterrupt:
             touch.quit()
+            reactor.close()
             break
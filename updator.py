@@ -4,18 +4,139 @@ from mutagen.mp4 import MP4
 from mutagen.flac import FLAC
 import glob
 import os
+import sys
 import json
 from functools import cmp_to_key
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
+from artwork import Thumbnail
+from catalog import Catalog
+
+class Manifest:
+    # 解析済みの音楽ファイルのサイズ・更新時刻・タグを記録しておき、
+    # 再スキャン時には変更されたファイル・新しいファイルだけを解析する
+    FILENAME = '.manifest.json'
+    VERSION = 1
+
+    def __init__(self, root):
+        self.__root_path = root
+        self.__path = os.path.join(root, Manifest.FILENAME)
+        self.__entries = {}     # 前回の記録 (ルートからの相対パス -> 記録)
+        self.__directories = None   # ディレクトリ -> そのディレクトリ直下の記録
+        self.__current = {}     # 今回のスキャンで見つかったファイルの記録
+        self.__parsed = 0
+        self.__reused = 0
+
+    @property
+    def parsed(self):
+        return self.__parsed
+
+    @property
+    def reused(self):
+        return self.__reused
+
+    @property
+    def current(self):
+        return self.__current
+
+    def load(self):
+        try:
+            with open(self.__path, mode='r', encoding='utf-8') as fp:
+                obj = json.load(fp)
+            if obj.get('version') == Manifest.VERSION:
+                self.__entries = obj['files']
+        except (OSError, ValueError, KeyError):
+            self.__entries = {}
+
+    def get_entries(self, directory):
+        # directory 直下のファイルの記録だけを取り出す (別プロセスで解析するときに渡す)
+        if self.__directories is None:
+            self.__directories = {}
+            for k, v in self.__entries.items():
+                self.__directories.setdefault(os.path.dirname(k), {})[k] = v
+        return self.__directories.get(os.path.relpath(directory, self.__root_path), {})
+
+    def set_entries(self, entries):
+        self.__entries = entries
+        self.__directories = None
+
+    def merge(self, other):
+        # 別プロセスで解析した結果を取り込む
+        self.__current.update(other.current)
+        self.__parsed += other.parsed
+        self.__reused += other.reused
+
+    def save(self):
+        # 今回見つからなかった(削除された)ファイルの記録はここで捨てられる
+        with open(self.__path, mode='w', encoding='utf-8') as fp:
+            files = {k: self.__current[k] for k in sorted(self.__current)}
+            json.dump({'version': Manifest.VERSION, 'files': files}, fp, ensure_ascii=False)
+
+    def get_song(self, music_file):
+        key = os.path.relpath(music_file, self.__root_path)
+        st = os.stat(music_file)
+        entry = self.__entries.get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            song = dict(entry['song'])
+            self.__reused += 1
+        else:
+            song = parse_file(music_file)
+            self.__parsed += 1
+        self.__current[key] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'song': song}
+        return dict(song)
+
+def parse_file(music_file):
+    ext = os.path.splitext(music_file)[-1].lower()
+    song = {'filename': os.path.split(music_file)[-1]}
+    if 'mp3' in ext:
+        f = MP3(music_file)
+        song['duration'] = round(f.info.length)
+        song['artist'] = str(f['TPE1'].text[0])
+        song['album'] = str(f['TALB'].text[0])
+        song['title'] = str(f['TIT2'].text[0])
+        song['year'] = int(str(f['TDRC'].text[0]))
+        song['index'] = int(str(f['TRCK'].text[0]).split('/')[0])
+    elif 'm4a' in ext:
+        f = MP4(music_file)
+        song['duration'] = round(f.info.length)
+        song['artist'] = f['\xa9ART'][0]
+        song['album'] = f['\xa9alb'][0]
+        song['title'] = f['\xa9nam'][0]
+        song['year'] = int(f['\xa9day'][0])
+        song['index'] = int(f['trkn'][0][0])
+    elif 'flac' in ext:
+        f = FLAC(music_file)
+        song['duration'] = round(f.info.length)
+        song['artist'] = f['artist'][0]
+        song['album'] = f['album'][0]
+        song['title'] = f['title'][0]
+        song['year'] = int(f['date'][0])
+        song['index'] = int(f['tracknumber'][0])
+    return song
+
+def list_music_files(directory):
+    return [f for f in glob.glob('{}/*'.format(directory)) if os.path.splitext(f)[-1].lower() in ['.mp3', '.m4a', '.flac']]
+
+def scan_album(root_path, directory, entries):
+    # 並列スキャン時にワーカープロセスで実行される
+    # 1つのアルバムのディレクトリを解析し、曲の一覧と、解析結果の記録を返す
+    manifest = Manifest(root_path)
+    manifest.set_entries(entries)
+    songs = [manifest.get_song(f) for f in list_music_files(directory)]
+    return songs, manifest
 
 class AlbumFolder:
-    def __init__(self, root, album_id):
+    def __init__(self, root, album_id, manifest=None):
         self.__id = album_id
         self.__root_path = root
         self.__songs = []
         self.__total_time = 0
+        self.__manifest = manifest
 
     @property
+    def path(self):
+        return self.__root_path
+    @property
     def artist_name(self):
         return self.__songs[0]['artist']
     @property
@@ -32,36 +153,19 @@ class AlbumFolder:
         return Image.open(image_path)
 
     def parse_files(self):
-        music_files = [f for f in glob.glob('{}/*'.format(self.__root_path)) if os.path.splitext(f)[-1].lower() in ['.mp3', '.m4a', '.flac']]
+        music_files = list_music_files(self.__root_path)
+        songs = []
         for music_file in music_files:
             # print(music_file)
-            ext = os.path.splitext(music_file)[-1].lower()
-            song = {'filename': os.path.split(music_file)[-1]}
-            if 'mp3' in ext:
-                f = MP3(music_file)
-                song['duration'] = round(f.info.length)
-                song['artist'] = str(f['TPE1'].text[0])
-                song['album'] = str(f['TALB'].text[0])
-                song['title'] = str(f['TIT2'].text[0])
-                song['year'] = int(str(f['TDRC'].text[0]))
-                song['index'] = int(str(f['TRCK'].text[0]).split('/')[0])
-            elif 'm4a' in ext:
-                f = MP4(music_file)
-                song['duration'] = round(f.info.length)
-                song['artist'] = f['\xa9ART'][0]
-                song['album'] = f['\xa9alb'][0]
-                song['title'] = f['\xa9nam'][0]
-                song['year'] = int(f['\xa9day'][0])
-                song['index'] = int(f['trkn'][0][0])
-            elif 'flac' in ext:
-                f = FLAC(music_file)
-                song['duration'] = round(f.info.length)
-                song['artist'] = f['artist'][0]
-                song['album'] = f['album'][0]
-                song['title'] = f['title'][0]
-                song['year'] = int(f['date'][0])
-                song['index'] = int(f['tracknumber'][0])
-            self.__songs.append(song)
+            if self.__manifest:
+                song = self.__manifest.get_song(music_file)
+            else:
+                song = parse_file(music_file)
+            songs.append(song)
+        self.set_songs(songs)
+
+    def set_songs(self, songs):
+        self.__songs = songs
         self.__songs.sort(key=lambda d: d['index'])
         self.__total_time = sum([s['duration'] for s in self.__songs])
 
@@ -76,10 +180,11 @@ class AlbumFolder:
         }
 
 class ArtistFolder:
-    def __init__(self, root, artist_id):
+    def __init__(self, root, artist_id, manifest=None):
         self.__id = artist_id
         self.__root_path = root
         self.__albums = []
+        self.__manifest = manifest
     
     @property
     def directory(self):
@@ -92,15 +197,23 @@ class ArtistFolder:
         return self.__albums
 
     def parse_files(self):
+        for album in self.collect():
+            album.parse_files()
+        self.finish()
+
+    def collect(self):
+        # アルバムのディレクトリを列挙し、ID を割り当てる (まだ解析はしない)
         album_folders = [f for f in glob.glob('{}/*'.format(self.__root_path)) if os.path.isdir(f)]
         if album_folders:
             album_folders.sort()
             for i, folder in enumerate(album_folders, self.__id+1):
                 # if os.path.isdir(folder):
-                album = AlbumFolder(folder, i)
-                album.parse_files()
+                album = AlbumFolder(folder, i, self.__manifest)
                 self.__albums.append(album) 
+        return self.__albums
 
+    def finish(self):
+        # 全てのアルバムの解析が終わった後で呼ぶ
         def cmp(a, b):
             if a.year == b.year:
                 return -1 if a.title < b.title else 1
@@ -132,8 +245,56 @@ class ArtistFolder:
             'albums': [album.to_json() for album in self.__albums]
         }
 
-def update(root_path, outname='database.json', callback=None):
+def make_thumbnails(root_path, artists):
+    # 表示用に縮小したアーティスト画像・カバーアートを作成する
+    thumbnail = Thumbnail(root_path)
+    for artist in artists:
+        sources = [os.path.join(root_path, artist.directory, 'artist.png')]
+        sources += [os.path.join(album.path, 'coverart.png') for album in artist.albums]
+        for source in sources:
+            if os.path.isfile(source):
+                thumbnail.generate(source)
+
+def parse_parallel(root_path, artists, manifest, jobs, callback=None):
+    # アルバムのディレクトリ単位でワーカープロセスに解析させ、終わったものから結果を受け取る
+    # ID はあらかじめ割り当て済みで、曲・アルバムの並べ替えは全て揃ってから行うので、
+    # 結果は逐次的に解析した場合と同じになる
+    remaining = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for artist in artists:
+            albums = artist.collect()
+            remaining[artist] = len(albums)
+            for album in albums:
+                future = executor.submit(scan_album, root_path, album.path, manifest.get_entries(album.path))
+                futures[future] = (artist, album)
+        done = 0
+        for artist in [a for a in artists if remaining[a] == 0]:
+            artist.finish()
+            done += 1
+            if callback:
+                callback(done, len(artists))
+        for future in as_completed(futures):
+            artist, album = futures[future]
+            songs, result = future.result()
+            album.set_songs(songs)
+            manifest.merge(result)
+            remaining[artist] -= 1
+            if remaining[artist] == 0:
+                artist.finish()
+                done += 1
+                if callback:
+                    callback(done, len(artists))
+
+def update(root_path, outname='database.json', callback=None, incremental=True, jobs=None):
+    # incremental が True の場合は、前回から変更のないファイルのタグの解析を省略する
+    # (出力されるデータベースは全てのファイルを解析した場合と同一になる)
+    # jobs は解析に使うプロセス数 (None の場合は CPU のコア数、1 の場合は並列化しない)
     print('updating {}'.format(outname))
+    manifest = Manifest(root_path)
+    if incremental:
+        manifest.load()
+    jobs = jobs or os.cpu_count() or 1
     try:
         artists = []
         directories = [d for d in glob.glob('{}/*'.format(root_path)) if os.path.isdir(d)]
@@ -141,19 +302,28 @@ def update(root_path, outname='database.json', callback=None):
         if callback:
             callback(0, len(directories))
         for n, directory in enumerate(directories, 1):
-            artist = ArtistFolder(directory, i)
-            artist.parse_files() 
+            artist = ArtistFolder(directory, i, manifest)
+            if jobs == 1:
+                artist.parse_files() 
+                if callback:
+                    callback(n, len(directories))
             # print(artist.name)
             # for album in artist.albums:
             #     print('  {}'.format(album.title))
             artists.append(artist)
-            if callback:
-                callback(n, len(directories))
             i += 100
+        if jobs > 1:
+            parse_parallel(root_path, artists, manifest, jobs, callback)
         artists.sort(key=lambda d: d.directory.lower())
+        make_thumbnails(root_path, artists)
         path = '{}/{}'.format(root_path, outname)
+        data = [artist.to_json() for artist in artists]
         with open(path, mode='w', encoding='utf-8') as fp:
-            json.dump([artist.to_json() for artist in artists], fp, indent=4, ensure_ascii=False)
+            json.dump(data, fp, indent=4, ensure_ascii=False)
+        # プレーヤーはバイナリ形式のカタログ (database.bin) を読み込む
+        Catalog.from_json(data).write(os.path.splitext(path)[0] + '.bin')
+        manifest.save()
+        print('{} file(s) parsed, {} file(s) unchanged'.format(manifest.parsed, manifest.reused))
 
     except Exception as e:
         raise
@@ -167,7 +337,9 @@ if __name__ == '__main__':
     def cb(pos, total):
         print('{} / {}'.format(pos, total))
 
-    if update('/media/usb', outname='database.json'): #, callback=cb):
+    incremental = '--full' not in sys.argv[1:]
+    jobs = int(sys.argv[sys.argv.index('--jobs')+1]) if '--jobs' in sys.argv else None
+    if update('/media/usb', outname='database.json', incremental=incremental, jobs=jobs): #, callback=cb):
         print('done')
 
 
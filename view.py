@@ -9,8 +9,8 @@ from ui import Label
 from ui import PaintBox
 
 from player import PlaybackState
+from player import Album
 
-from PIL import Image
 import pygame
 import time
 import datetime
@@ -154,6 +154,8 @@ class ArtistListView(UIWidget):
         self.__artist_list = artist_list
         self.__current_artist = None
         self.__page = 0
+        self.__version = -1         # 前回表示したときの ArtistList.version
+        self.__locating = False     # current_artist がまだ読み込まれていない
         self.__buttons = {
             'up': Button(self, icon='chevron-up'),
             'close': Button(self, icon='close'),
@@ -192,13 +194,13 @@ class ArtistListView(UIWidget):
     def set_page(self, *, page=0, current_artist=None):
         if current_artist:
             self.__current_artist = current_artist
-            found = [i for i, artist in enumerate(self.__artist_list.artists) if artist.artist_id == current_artist.artist_id]
-            if found:
-                self.__page = found[0] // self.NUM_PANELS
-            else:
-                self.__page = 0
+            index = self.__artist_list.get_index_of_artist(current_artist)
+            self.__page = index // self.NUM_PANELS if index >= 0 else 0
+            self.__locating = index < 0 and not self.__artist_list.loaded
         else:
             self.__page = page
+            self.__locating = False
+        self.__version = self.__artist_list.version
         artists = self.__artist_list.artists[self.__page*self.NUM_PANELS:]
         if len(artists) <= self.NUM_PANELS:
             self.__buttons['down'].disable()
@@ -223,6 +225,18 @@ class ArtistListView(UIWidget):
                 panel.disable()
         self.refresh()        
 
+    def update_list(self):
+        # バックグラウンドでの読み込みやライブラリの変更により一覧が変化していれば表示を更新する
+        if self.__artist_list.version == self.__version:
+            return
+        if not self.is_visible():
+            return
+        if self.__locating:
+            self.set_page(current_artist=self.__current_artist)
+        else:
+            last_page = max(0, self.__artist_list.num_artists - 1) // self.NUM_PANELS
+            self.set_page(page=min(self.__page, last_page))
+
     def draw_header(self, header):
         header.canvas.clear(self.HEADER_BKCOL[0])
         n = len(self.__artist_list.artists)
@@ -246,8 +260,9 @@ class ArtistListView(UIWidget):
         panel.canvas.draw_text((12, 20), artist.name, fgcol)
         panel.canvas.draw_text((12, 60), '{} album(s)'.format(len(artist.albums)), fgcol)
         panel.canvas.draw_rect((r.width-149, 1, 148, 148), (0x56, 0x56, 0x56))
-        image = artist.image.resize((146, 146), resample=Image.BICUBIC)
-        panel.canvas.draw_image(image, (r.width-148, 2, 146, 146))
+        image = artist.get_thumbnail((146, 146))
+        if image:
+            panel.canvas.draw_image(image, (r.width-148, 2, 146, 146))
 
     def on_up(self, param):
         self.set_page(page=self.__page-1)
@@ -342,11 +357,11 @@ class AlbumListView(UIWidget):
 
     def set_current(self, current_album):
         self.__current_album = current_album
-        found = [i for i, album in enumerate(self.__artist.albums) if album.album_id == self.__current_album.album_id]
-        if not found:
+        index = self.__artist.get_index_of_album(current_album)
+        if index < 0:
             self.set_page(0)
             return
-        page = found[0] // self.NUM_PANELS
+        page = index // self.NUM_PANELS
         self.set_page(page)
 
     def draw_header(self, header):
@@ -373,8 +388,9 @@ class AlbumListView(UIWidget):
         text = '{0} tracks / {1:0>2}:{2:0>2}'.format(album.num_tracks, album.total_time // 60, album.total_time % 60)
         panel.canvas.draw_text_rect((12, 120, 340, 30), text, TextAlign.RIGHT, fgcol)
         panel.canvas.draw_rect((r.width-149, 1, 148, 148), (0x56, 0x56, 0x56))
-        image = album.image.resize((146, 146), resample=Image.BICUBIC)
-        panel.canvas.draw_image(image, (r.width-148, 2, 146, 146))
+        image = album.get_thumbnail((146, 146))
+        if image:
+            panel.canvas.draw_image(image, (r.width-148, 2, 146, 146))
 
     def on_up(self, param):
         self.set_page(self.__page - 1)
@@ -396,6 +412,14 @@ class AlbumListView(UIWidget):
             print(album.title)
             self.trigger_event('select', album)
 
+    def update_list(self, artist):
+        # 表示中のアーティストのアルバムが追加・削除された場合に表示を更新する
+        if not self.__artist or artist.artist_id != self.__artist.artist_id or not self.is_visible():
+            return
+        self.__artist = artist
+        last_page = max(0, artist.num_albums - 1) // self.NUM_PANELS
+        self.set_page(min(self.__page, last_page))
+
     def set_artist(self, artist, album=None):
         self.__artist = artist
         if album:
@@ -482,8 +506,8 @@ class PlaybackView(UIWidget):
         self.canvas.draw_rect((Canvas.SCREEN_WIDTH-251, 79, 242, 242), (0x56, 0x56, 0x56))
 
     def draw_image(self, panel):
-        if self.__album:
-            image = self.__album.image.resize((240, 240), resample=Image.BICUBIC)
+        image = self.__album.get_thumbnail(Album.IMAGE_SIZE) if self.__album else None
+        if image:
             panel.canvas.draw_image(image, panel.client_rect)
         else:
             panel.canvas.clear(self.BKCOL)
@@ -511,6 +535,9 @@ class PlaybackView(UIWidget):
         panel.canvas.draw_text_rect((r.width-70, 50, 60, 30), text, TextAlign.RIGHT, fgcol)
 
     def set_album(self, album):
+        # 演奏中のアルバムを開き直した場合は MPD に何も送られず、song・state の変化も通知されないので、
+        # 一覧を先頭に戻した後で、現在の状態から演奏中の曲を表示し直す
+        reopened = self.__album is not None and self.__album.album_id == album.album_id
         self.__album = album
         for panel in self.__track_panels:
             panel.tag['song'] = None
@@ -520,6 +547,9 @@ class PlaybackView(UIWidget):
         self.__labels['artist_name'].text = album.artist.name
         self.__labels['year'].text = 'released : {}'.format(album.year)
         self.__labels['info'].text = '{0} tracks / {1:0>2}:{2:0>2}'.format(album.num_tracks, album.total_time // 60, album.total_time % 60)
+        status = self.__player.status
+        if reopened and status.state != PlaybackState.STOP:
+            self.update({'song': status.song+1, 'state': status.state})
 
     def on_select(self, panel):
         index = panel.tag['song'].track_index - 1
@@ -543,7 +573,7 @@ class PlaybackView(UIWidget):
             panel.tag['selected'] = self.__track_panels[i+1].tag['selected']
             panel.refresh()
         bottom_panel = self.__track_panels[-1]
-        bottom_panel.tag['song'] = self.__album.songs[last_song.track_index]
+        bottom_panel.tag['song'] = self.__album.get_song(last_song.track_index)
         bottom_panel.refresh()
         self.unselect_all()
         status = self.__player.status
@@ -567,7 +597,7 @@ class PlaybackView(UIWidget):
             panel.tag['selected'] = self.__track_panels[i-1].tag['selected']
             panel.refresh()
         top_panel = self.__track_panels[0]
-        top_panel.tag['song'] = self.__album.songs[first_song.track_index-2]
+        top_panel.tag['song'] = self.__album.get_song(first_song.track_index-2)
         top_panel.refresh()
         self.unselect_all()
         status = self.__player.status
@@ -600,7 +630,7 @@ class PlaybackView(UIWidget):
 
         for track_index, panel in zip(indices, self.__track_panels):
             if track_index > 0:
-                panel.tag['song'] = self.__album.songs[track_index-1]
+                panel.tag['song'] = self.__album.get_song(track_index-1)
             else:
                 panel.tag['song'] = None
             panel.tag['selected'] = False
@@ -690,9 +720,11 @@ if __name__ == '__main__':
 
     while not terminated:
         modified_states = player.get_modified() or {}
+        touch.read_device()
         touch.dispatch_event()
         navigation_view.update(modified_states)
         playback_view.update(modified_states)
+        UIWidget.frames.flush()
         time.sleep(0.1)
     touch.quit()
     touch = None
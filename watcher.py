@@ -0,0 +1,213 @@
+import os
+import time
+import queue
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+from updator import AlbumFolder, list_music_files
+from artwork import Thumbnail
+
+
+# ------------------------------------------------------------------------------
+class Inotify:
+    IN_MODIFY      = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+
+    EVENT = struct.Struct('iIII')   # wd, mask, cookie, len
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.__watches = {}     # wd -> パス
+
+    def fileno(self):
+        return self.__fd
+
+    def add_watch(self, path, mask):
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.__watches[wd] = path
+        return wd
+
+    def read(self):
+        # (パス, mask, 名前) のリストを返す。イベントが無ければ空のリスト
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = Inotify.EVENT.unpack_from(data, pos)
+            pos += Inotify.EVENT.size
+            name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+            pos += length
+            path = self.__watches.get(wd)
+            if mask & Inotify.IN_IGNORED:
+                self.__watches.pop(wd, None)
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.__fd)
+
+
+# ------------------------------------------------------------------------------
+class LibraryWatcher:
+    # Artist.ROOT_PATH 以下の変更を inotify で監視し、変更のあったアルバムのディレクトリだけを
+    # 解析し直して、ArtistList.apply_delta で反映できる差分として通知する
+    #   <root>/<アーティスト>/<アルバム>/<曲ファイル> の3階層を監視する
+    DEBOUNCE = 2.0      # 最後の変更からこの秒数だけ変更が無ければ解析する (アルバムのコピー中は待つ)
+    MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO |
+            Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_DELETE_SELF)
+
+    def __init__(self, root, artist_list):
+        self.__root_path = root
+        self.__artist_list = artist_list
+        self.__inotify = Inotify()
+        self.__artist_ids = {}  # アーティストのディレクトリ名 -> アーティストID
+        self.__album_ids = {}   # (アーティストのディレクトリ名, アルバムのディレクトリ名) -> アルバムID
+        self.__pending = set()  # 解析し直すアルバムのディレクトリ
+        self.__last_event = 0
+        self.__queue = queue.Queue()
+        self.__notify = None
+        self.__terminated = False
+        self.__thread = threading.Thread(target=self.execute)
+        self.__thread.start()
+
+    def quit(self):
+        self.__terminated = True
+        self.__thread.join()
+        self.__inotify.close()
+        print('LibraryWatcher: terminated')
+
+    def get_delta(self):
+        return self.__queue.get() if not self.__queue.empty() else None
+
+    def set_notify(self, callback):
+        # get_delta で取り出せる差分が増えたときに、監視のスレッドから callback() を呼ぶ
+        self.__notify = callback
+
+    def execute(self):
+        # バックグラウンドでの読み込みが終わってから、現在のIDを記録して監視を始める
+        self.__artist_list.wait()
+        for artist in self.__artist_list.artists:
+            self.__artist_ids[artist.directory] = artist.artist_id
+            for album in artist.albums:
+                self.__album_ids[(artist.directory, album.directory)] = album.album_id
+        self.watch(self.__root_path, 0, False)
+
+        while not self.__terminated:
+            r, w, x = select.select([self.__inotify], [], [], 0.5)
+            if r:
+                for path, mask, name in self.__inotify.read():
+                    self.on_event(path, mask, name)
+            if self.__pending and time.time() - self.__last_event >= self.DEBOUNCE:
+                self.flush()
+
+    def watch(self, path, depth, created=True):
+        # depth 0: ルート、1: アーティスト、2: アルバム
+        # 監視開始後に作られたアルバムのディレクトリは解析の対象にする
+        try:
+            self.__inotify.add_watch(path, self.MASK)
+            if depth < 2:
+                for name in os.listdir(path):
+                    child = os.path.join(path, name)
+                    if os.path.isdir(child) and not name.startswith('.'):
+                        self.watch(child, depth + 1, created)
+            elif created:
+                self.__pending.add(path)
+        except OSError as e:
+            print('LibraryWatcher: unable to watch {} ({})'.format(path, e))
+
+    def depth(self, path):
+        rel = os.path.relpath(path, self.__root_path)
+        return 0 if rel == '.' else rel.count(os.sep) + 1
+
+    def on_event(self, path, mask, name):
+        if mask & Inotify.IN_Q_OVERFLOW:
+            # イベントを取りこぼしたので、全てのアルバムを解析し直す
+            print('LibraryWatcher: event queue overflow')
+            for artist, album in self.__album_ids:
+                self.__pending.add(os.path.join(self.__root_path, artist, album))
+            self.__last_event = time.time()
+            return
+        if path is None or not name or name.startswith('.'):
+            return
+        full_path = os.path.join(path, name)
+        depth = self.depth(path)
+        created = mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+        removed = mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM)
+        if depth < 2 and mask & Inotify.IN_ISDIR:
+            if created:
+                self.watch(full_path, depth + 1)
+            elif removed:
+                # 削除されたディレクトリに含まれていたアルバムを全て解析し直す (= 削除を通知する)
+                rel = os.path.relpath(full_path, self.__root_path).split(os.sep)
+                for artist, album in self.__album_ids:
+                    if [artist, album][:len(rel)] == rel:
+                        self.__pending.add(os.path.join(self.__root_path, artist, album))
+        elif depth == 2:
+            self.__pending.add(path)
+        else:
+            return
+        self.__last_event = time.time()
+
+    def flush(self):
+        pending, self.__pending = self.__pending, set()
+        for path in sorted(pending):
+            try:
+                delta = self.parse_album(path)
+            except Exception as e:
+                # コピー途中のファイルなどで解析に失敗した場合は、次の変更を待って再度解析する
+                print('LibraryWatcher: failed to parse {} ({})'.format(path, e))
+                continue
+            if delta:
+                self.__queue.put(delta)
+                if self.__notify:
+                    self.__notify()
+
+    def parse_album(self, path):
+        artist_dir, album_dir = os.path.relpath(path, self.__root_path).split(os.sep)
+        album_id = self.__album_ids.get((artist_dir, album_dir))
+        if not os.path.isdir(path) or not list_music_files(path):
+            if album_id is None:
+                return None
+            del self.__album_ids[(artist_dir, album_dir)]
+            print('LibraryWatcher: removed {}'.format(path))
+            return {'type': 'remove', 'artist': self.__artist_ids[artist_dir], 'album': album_id}
+
+        artist_id = self.__artist_ids.get(artist_dir)
+        if artist_id is None:
+            artist_id = self.__artist_ids[artist_dir] = max(self.__artist_ids.values(), default=0) + 100
+        if album_id is None:
+            # アーティストIDに続く番号を割り当てる (updator と同じ規則)
+            used = [v for (a, b), v in self.__album_ids.items() if a == artist_dir]
+            album_id = self.__album_ids[(artist_dir, album_dir)] = max(used, default=artist_id) + 1
+
+        album = AlbumFolder(path, album_id)
+        album.parse_files()
+        for source in [os.path.join(path, 'coverart.png'), os.path.join(self.__root_path, artist_dir, 'artist.png')]:
+            if os.path.isfile(source):
+                Thumbnail(self.__root_path).generate(source)
+        print('LibraryWatcher: updated {}'.format(path))
+        return {
+            'type': 'album',
+            'artist': {'id': artist_id, 'name': album.artist_name, 'directory': artist_dir},
+            'album': album.to_json()
+        }